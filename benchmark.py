@@ -0,0 +1,618 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:02:41 2026
+
+Contains functions for benchmarking the image-processing functions on
+synthetic images of sheath flow with a known stream width, tilt, noise, and
+number of speckles. Results are appended to a JSON-lines file so that runs
+can be compared over time (see run_benchmarks and load_bench_results).
+Also compares the flow calculations with the precomputed flow.Rig
+(bench_rig).
+
+@author: Andy
+"""
+
+import datetime
+import json
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import skimage.measure
+
+import flow
+import improc
+
+
+# resolutions (rows, cols) of synthetic images from VGA to 4K
+RESOLUTIONS = [(480, 640), (720, 1280), (1080, 1920), (2160, 3840)]
+
+
+def make_synthetic_frame(shape=(480, 640), width=0.25, angle=0.02,
+                         noise=0.03, n_speckles=50, seed=0):
+    """
+    Generates an RGB image of a dark blue stream flowing roughly horizontally
+    across a bright background, like the images of sheath flow.
+
+    Parameters:
+        shape : tuple of ints, optional
+            (rows, cols) of the image
+        width : float, optional
+            Width of the stream perpendicular to its axis as a fraction of the
+            number of rows (if < 1) or in pixels (if >= 1)
+        angle : float, optional
+            Tilt of the stream from horizontal [rad]
+        noise : float, optional
+            Standard deviation of Gaussian noise added to each channel (the
+            image intensity ranges from 0 to 1)
+        n_speckles : int, optional
+            Number of dark 3x3 speckles randomly placed in the background
+        seed : int, optional
+            Seed for the noise and speckles
+
+    Returns:
+        im : 3D array of uint8
+            Synthetic RGB image
+        mask : 2D array of bools
+            True for pixels of the stream
+        width_pix : float
+            True width of the stream [pixels]
+    """
+    rng = np.random.default_rng(seed)
+    n_rows, n_cols = shape
+    width_pix = width*n_rows if width < 1 else width
+    rows, cols = np.mgrid[0:n_rows, 0:n_cols]
+    # distance of each pixel from the axis of the stream through the center
+    center_row = n_rows/2 + np.tan(angle)*(cols - n_cols/2)
+    dist = np.abs(rows - center_row)*np.cos(angle)
+    mask = dist < width_pix/2
+    im = np.empty(shape + (3,), dtype='float32')
+    im[...] = [0.85, 0.87, 0.9]
+    im[mask] = [0.2, 0.3, 0.75]
+    # dark speckles (e.g., dust) in the background
+    for r, c in zip(rng.integers(1, n_rows - 1, n_speckles),
+                    rng.integers(1, n_cols - 1, n_speckles)):
+        if not np.any(mask[r-1:r+2, c-1:c+2]):
+            im[r-1:r+2, c-1:c+2] = [0.2, 0.3, 0.75]
+    im += rng.normal(0, noise, im.shape).astype('float32')
+    im = (255*np.clip(im, 0, 1)).astype('uint8')
+
+    return im, mask, width_pix
+
+
+def bench_measure_stream_width(shape=(480, 640), n_frames=5, params=None,
+                               **frame_kwargs):
+    """
+    Times improc.measure_stream_width on synthetic frames and measures its
+    error in width against the ground truth.
+
+    Parameters:
+        shape : tuple of ints, optional
+            (rows, cols) of the frames
+        n_frames : int, optional
+            Number of frames (each with a different seed for the noise)
+        params : list, optional
+            Parameters of measure_stream_width (um_per_pix should be 1 so
+            widths are in pixels); default is [1, None]
+        frame_kwargs : optional
+            Keyword arguments of make_synthetic_frame
+
+    Returns:
+        result : dict
+            Frames per second, time per frame [s], peak memory allocated
+            during one frame [bytes], and mean and max absolute error in width
+            relative to the true width
+    """
+    params = [1, None] if params is None else params
+    frames = [make_synthetic_frame(shape, seed=seed, **frame_kwargs)
+              for seed in range(n_frames)]
+    errors = []
+    t_start = time.perf_counter()
+    for im, mask, width_pix in frames:
+        width = improc.measure_stream_width(im, params)[0]
+        errors += [abs(width - width_pix) / width_pix]
+    t_frame = (time.perf_counter() - t_start) / n_frames
+    peak = _get_peak_memory(improc.measure_stream_width, frames[0][0], params)
+    result = {'fps' : 1 / t_frame, 't_frame' : t_frame, 'peak_mem' : peak,
+              'width_err_mean' : np.mean(errors),
+              'width_err_max' : np.max(errors)}
+
+    return result
+
+
+def bench_measure_labeled_im_width(shape=(480, 640), n_repeat=5,
+                                   **frame_kwargs):
+    """
+    Times improc.measure_labeled_im_width and improc.get_angle_correction on
+    the true stream mask of a synthetic frame and measures the error in width.
+
+    Parameters:
+        shape : tuple of ints, optional
+            (rows, cols) of the frame
+        n_repeat : int, optional
+            Number of times to time each function (fastest time is reported)
+        frame_kwargs : optional
+            Keyword arguments of make_synthetic_frame
+
+    Returns:
+        result : dict
+            Time per call [s] of each function, frames per second of
+            measure_labeled_im_width, peak memory [bytes], and error in width
+            relative to the true width
+    """
+    im, mask, width_pix = make_synthetic_frame(shape, **frame_kwargs)
+    t_width = min(_time_fn(improc.measure_labeled_im_width, mask, 1)
+                  for i in range(n_repeat))
+    t_angle = min(_time_fn(improc.get_angle_correction, mask)
+                  for i in range(n_repeat))
+    width = improc.measure_labeled_im_width(mask, 1)[0]
+    peak = _get_peak_memory(improc.measure_labeled_im_width, mask, 1)
+    result = {'fps' : 1 / t_width, 't_frame' : t_width,
+              't_angle_correction' : t_angle, 'peak_mem' : peak,
+              'width_err_mean' : abs(width - width_pix) / width_pix}
+
+    return result
+
+
+def bench_proc_im_seq(shape=(480, 640), n_frames=10, params=None,
+                      proc_kwargs=None, **frame_kwargs):
+    """
+    Times improc.proc_im_seq with improc.measure_stream_width end to end,
+    including loading the images from JPEG files in a temporary folder.
+
+    Parameters:
+        shape : tuple of ints, optional
+            (rows, cols) of the frames
+        n_frames : int, optional
+            Number of frames
+        params : list, optional
+            Parameters of measure_stream_width; default is [1, None]
+        proc_kwargs : dict, optional
+            Keyword arguments of proc_im_seq (e.g., workers)
+        frame_kwargs : optional
+            Keyword arguments of make_synthetic_frame
+
+    Returns:
+        result : dict
+            Frames per second, time per frame [s], peak memory allocated
+            while processing one frame (including loading it) [bytes], and
+            mean and max absolute error in width relative to the true width
+    """
+    params = [1, None] if params is None else params
+    proc_kwargs = {} if proc_kwargs is None else proc_kwargs
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        im_path_list = []
+        widths_true = []
+        for seed in range(n_frames):
+            im, mask, width_pix = make_synthetic_frame(shape, seed=seed,
+                                                       **frame_kwargs)
+            im_path = os.path.join(tmp_dir, 'frame_{0:05d}.jpg'.format(seed))
+            plt.imsave(im_path, im)
+            im_path_list += [im_path]
+            widths_true += [width_pix]
+        t_start = time.perf_counter()
+        output = improc.proc_im_seq(im_path_list, improc.measure_stream_width,
+                                    params, verbose=False, **proc_kwargs)
+        t_frame = (time.perf_counter() - t_start) / n_frames
+        # peak memory of a separate run on one frame (with workers, only the
+        # memory of this process is traced)
+        peak = _get_peak_memory(lambda: improc.proc_im_seq(
+                                    im_path_list[:1],
+                                    improc.measure_stream_width, params,
+                                    verbose=False, **proc_kwargs))
+    errors = [abs(result[0] - width_pix) / width_pix
+              for result, width_pix in zip(output, widths_true)]
+    result = {'fps' : 1 / t_frame, 't_frame' : t_frame, 'peak_mem' : peak,
+              'width_err_mean' : np.mean(errors),
+              'width_err_max' : np.max(errors)}
+
+    return result
+
+
+def compare_engines(shape=(1080, 1920), n_frames=3, conditions=None):
+    """
+    Compares the accuracy and speed of the k-means and edge-profile engines of
+    improc.measure_stream_width on synthetic frames under different
+    conditions.
+
+    Parameters:
+        shape : tuple of ints, optional
+            (rows, cols) of the frames
+        n_frames : int, optional
+            Number of frames per condition
+        conditions : dict of dicts, optional
+            Keyword arguments of make_synthetic_frame for each named
+            condition (default covers a clean frame, a tilted stream, a
+            narrow stream, heavy noise, and many speckles)
+
+    Returns:
+        df : Pandas DataFrame
+            Time per frame [s] and mean and max error in width relative to
+            the true width for each engine under each condition
+    """
+    if conditions is None:
+        conditions = {'clean' : {'noise' : 0.01, 'n_speckles' : 0},
+                      'tilted' : {'angle' : 0.1},
+                      'narrow' : {'width' : 12.5},
+                      'noisy' : {'noise' : 0.1},
+                      'speckled' : {'n_speckles' : 2000}}
+    rows = []
+    for name, frame_kwargs in conditions.items():
+        for engine in ['kmeans', 'edge']:
+            params = [1, None, {'engine' : engine}]
+            row = {'condition' : name, 'engine' : engine}
+            row.update(bench_measure_stream_width(shape, n_frames=n_frames,
+                                                  params=params,
+                                                  **frame_kwargs))
+            rows += [row]
+
+    return pd.DataFrame(rows)
+
+
+def compare_channels(shape=(1080, 1920), n_frames=3,
+                     channels=(None, 0, 1, 2, 'gray'), engine='kmeans',
+                     **frame_kwargs):
+    """
+    Checks that the widths measured by improc.measure_stream_width on a
+    single channel of synthetic frames (opts['channel']) match those measured
+    on the full RGB frames, and compares their speed and peak memory.
+
+    Parameters:
+        shape : tuple of ints, optional
+            (rows, cols) of the frames
+        n_frames : int, optional
+            Number of frames
+        channels : list, optional
+            Channels to compare (see improc.select_channel); None is the RGB
+            path
+        engine : string, optional
+            Engine of measure_stream_width ('kmeans' or 'edge')
+        frame_kwargs : optional
+            Keyword arguments of make_synthetic_frame
+
+    Returns:
+        df : Pandas DataFrame
+            Time per frame [s], peak memory [bytes], error in width relative
+            to the true width, and largest difference in width from the RGB
+            path relative to the true width for each channel
+    """
+    frames = [make_synthetic_frame(shape, seed=seed, **frame_kwargs)
+              for seed in range(n_frames)]
+    widths = {}
+    rows = []
+    for channel in channels:
+        params = [1, None, {'channel' : channel, 'engine' : engine}]
+        t_start = time.perf_counter()
+        widths[str(channel)] = np.array([
+                    improc.measure_stream_width(im, params)[0]
+                    for im, _, _ in frames])
+        t_frame = (time.perf_counter() - t_start) / n_frames
+        true_widths = np.array([width_pix for _, _, width_pix in frames])
+        errors = np.abs(widths[str(channel)] - true_widths) / true_widths
+        rows += [{'channel' : str(channel), 't_frame' : t_frame,
+                  'peak_mem' : _get_peak_memory(improc.measure_stream_width,
+                                                frames[0][0], params),
+                  'width_err_mean' : np.mean(errors),
+                  'width_err_max' : np.max(errors),
+                  'diff_rgb_max' : np.nan if 'None' not in widths else
+                        np.max(np.abs(widths[str(channel)] - widths['None']) /
+                               true_widths)}]
+
+    return pd.DataFrame(rows)
+
+
+def compare_fit_methods(shape=(1080, 1920), n_frames=3,
+                        methods=('full', 'random', 'strided', 'minibatch'),
+                        n_sample=10000, tol=0.01, **frame_kwargs):
+    """
+    Checks that the widths measured by improc.measure_stream_width with the
+    centroids of a subsampled fit (improc.fit_stream_centroids) stay within
+    the given tolerance of those measured with the centroids of the 'full'
+    fit, and compares the time of each fit.
+
+    Parameters:
+        shape : tuple of ints, optional
+            (rows, cols) of the frames
+        n_frames : int, optional
+            Number of frames (the fit uses the first one)
+        methods : list, optional
+            Methods of fit_stream_centroids to compare ('full' is always
+            included as the reference)
+        n_sample : int, optional
+            Number of pixels of the subsampled fits (see fit_stream_centroids)
+        tol : float, optional
+            Largest difference in width from the 'full' fit relative to its
+            width
+        frame_kwargs : optional
+            Keyword arguments of make_synthetic_frame
+
+    Returns:
+        df : Pandas DataFrame
+            Time of the fit [s], error in width relative to the true width,
+            largest difference in width from the 'full' fit relative to its
+            width, and whether it is within the tolerance for each method
+    """
+    frames = [make_synthetic_frame(shape, seed=seed, **frame_kwargs)
+              for seed in range(n_frames)]
+    true_widths = np.array([width_pix for _, _, width_pix in frames])
+    widths = {}
+    rows = []
+    for method in ['full'] + [m for m in methods if m != 'full']:
+        t_start = time.perf_counter()
+        centroids = improc.fit_stream_centroids([frames[0][0]],
+                                                method=method,
+                                                n_sample=n_sample,
+                                                random_state=0)
+        t_fit = time.perf_counter() - t_start
+        params = [1, None, {'centroids' : centroids}]
+        widths[method] = np.array([improc.measure_stream_width(im, params)[0]
+                                   for im, _, _ in frames])
+        errors = np.abs(widths[method] - true_widths) / true_widths
+        diff = np.max(np.abs(widths[method] - widths['full']) /
+                      widths['full'])
+        rows += [{'method' : method, 't_fit' : t_fit,
+                  'width_err_mean' : np.mean(errors),
+                  'width_err_max' : np.max(errors),
+                  'diff_full_max' : diff, 'within_tol' : diff <= tol}]
+
+    return pd.DataFrame(rows)
+
+
+def run_benchmarks(resolutions=RESOLUTIONS, n_frames=5, frame_kwargs=None,
+                   results_path='benchmark_results.jsonl', label=''):
+    """
+    Runs the benchmarks of improc at each resolution and appends the results
+    to a JSON-lines file with the date, git commit, and label of the run so
+    runs can be compared over time (see load_bench_results).
+
+    Parameters:
+        resolutions : list of tuples, optional
+            (rows, cols) of the synthetic frames
+        n_frames : int, optional
+            Number of frames for each benchmark
+        frame_kwargs : dict, optional
+            Keyword arguments of make_synthetic_frame (width, angle, noise,
+            n_speckles)
+        results_path : string, optional
+            JSON-lines file to append results to (None to not save)
+        label : string, optional
+            Label of the run (e.g., description of the change tested)
+
+    Returns:
+        df : Pandas DataFrame
+            Results with one row per benchmark per resolution
+    """
+    frame_kwargs = {} if frame_kwargs is None else frame_kwargs
+    run_info = {'date' : datetime.datetime.now().isoformat(timespec='seconds'),
+                'commit' : _get_git_commit(), 'label' : label}
+    benchmarks = {
+        'measure_stream_width' : lambda shape: bench_measure_stream_width(
+                                    shape, n_frames=n_frames, **frame_kwargs),
+        'measure_labeled_im_width' : lambda shape:
+                    bench_measure_labeled_im_width(shape, **frame_kwargs),
+        'proc_im_seq' : lambda shape: bench_proc_im_seq(shape,
+                                    n_frames=n_frames, **frame_kwargs),
+    }
+    rows = []
+    for shape in resolutions:
+        for name, bench in benchmarks.items():
+            row = dict(run_info, benchmark=name, rows=shape[0], cols=shape[1],
+                       **frame_kwargs)
+            row.update(bench(tuple(shape)))
+            print(row)
+            rows += [row]
+    if results_path is not None:
+        with open(results_path, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(row, default=float) + '\n')
+
+    return pd.DataFrame(rows)
+
+
+def load_bench_results(results_path='benchmark_results.jsonl'):
+    """
+    Loads the results of all runs saved by run_benchmarks.
+
+    Parameters:
+        results_path : string, optional
+            JSON-lines file of results
+
+    Returns:
+        df : Pandas DataFrame
+            Results with one row per benchmark per resolution per run
+    """
+    with open(results_path, 'r') as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+
+    return pd.DataFrame(rows)
+
+
+def make_noisy_labels(shape=(1080, 1920), width=120, speckle_frac=0.05,
+                      seed=0):
+    """
+    Generates a clustered image (0 for background, 1 for stream) with a
+    horizontal stream and randomly placed speckles of stream-labeled pixels.
+
+    Parameters:
+        shape : tuple of ints, optional
+            (rows, cols) of the image
+        width : int, optional
+            Width of the stream [pixels]
+        speckle_frac : float, optional
+            Fraction of pixels randomly labeled as stream
+        seed : int, optional
+            Seed for the random speckles
+
+    Returns:
+        im_clustered : 2D array of uint8
+            Labeled image
+    """
+    rng = np.random.default_rng(seed)
+    im_clustered = (rng.random(shape) < speckle_frac).astype('uint8')
+    # stream in the middle of the image
+    top = (shape[0] - width) // 2
+    im_clustered[top:top+width, :] = 1
+
+    return im_clustered
+
+
+def bench_widest_region(shape=(1080, 1920), speckle_frac=0.05, n_repeat=3):
+    """
+    Compares improc.get_widest_region to the loop over regionprops it
+    replaced on a noisy image. Checks that both give the same region.
+
+    Parameters:
+        shape : tuple of ints, optional
+            (rows, cols) of the image
+        speckle_frac : float, optional
+            Fraction of pixels randomly labeled as stream
+        n_repeat : int, optional
+            Number of times to time each method (fastest time is reported)
+
+    Returns:
+        result : dict
+            Number of regions, time of each method [s], and speedup
+    """
+    im_clustered = make_noisy_labels(shape, speckle_frac=speckle_frac)
+    t_loop = min(_time_fn(_widest_region_regionprops, im_clustered)
+                 for i in range(n_repeat))
+    t_fast = min(_time_fn(improc.get_widest_region, im_clustered)
+                 for i in range(n_repeat))
+    # both methods must find the same region
+    assert np.array_equal(_widest_region_regionprops(im_clustered),
+                          improc.get_widest_region(im_clustered)), \
+        "get_widest_region does not match the regionprops loop."
+    num = skimage.measure.label(im_clustered, return_num=True)[1]
+    result = {'n_regions' : num, 't_regionprops' : t_loop,
+              't_widest_region' : t_fast, 'speedup' : t_loop / t_fast}
+
+    return result
+
+
+def bench_rig(n_points=1000, n_array=10**6, eta=1.412, n_repeat=3,
+              **geometry):
+    """
+    Compares the flow rates and pressures computed with a flow.Rig (geometry
+    and resistances precomputed) to the functions of flow, both in a loop
+    over scalar pressures (like a loop in a notebook) and in one call on
+    arrays. Checks that both give the same results.
+
+    Parameters:
+        n_points : int, optional
+            Number of pressures in the loop over scalars
+        n_array : int, optional
+            Number of pressures in the call on arrays
+        eta : float, optional
+            Viscosity [Pa.s]
+        n_repeat : int, optional
+            Number of times to time each method (fastest time is reported)
+        geometry : optional
+            Geometry of the rig (see flow.get_flow_rates)
+
+    Returns:
+        df : Pandas DataFrame
+            Time of the functions and the rig [s] and speedup for each
+            calculation
+    """
+    rig = flow.Rig(**geometry)
+    geometry = rig.get_geometry()
+    rng = np.random.default_rng(0)
+    p_i = rng.uniform(10, 20, n_array)
+    p_o = rng.uniform(5, 10, n_array)
+    Q_i, Q_o = rig.get_flow_rates(eta, p_i=p_i, p_o=p_o)
+    # (function of flow, method of rig, arguments) of each calculation
+    calcs = {'get_flow_rates' : (
+                lambda p_i, p_o: flow.get_flow_rates(eta, p_i=p_i, p_o=p_o,
+                                                     **geometry),
+                lambda p_i, p_o: rig.get_flow_rates(eta, p_i=p_i, p_o=p_o),
+                (p_i, p_o)),
+             'get_pressures' : (
+                lambda Q_i, Q_o: flow.get_pressures(eta, Q_i, Q_o,
+                                                    **geometry),
+                lambda Q_i, Q_o: rig.get_pressures(eta, Q_i, Q_o),
+                (Q_i, Q_o))}
+    rows = []
+    for name, (fn, method, args) in calcs.items():
+        assert np.allclose(fn(*args), method(*args), rtol=1E-9), \
+            "Rig.{0} does not match flow.{0}.".format(name)
+        loop = lambda f: [f(*[float(arg[i]) for arg in args])
+                          for i in range(n_points)]
+        for mode, run in [('scalar loop', loop),
+                          ('array', lambda f: f(*args))]:
+            t_fn = min(_time_fn(run, fn) for i in range(n_repeat))
+            t_rig = min(_time_fn(run, method) for i in range(n_repeat))
+            rows += [{'calculation' : name, 'mode' : mode,
+                      'n' : n_points if mode == 'scalar loop' else n_array,
+                      't_fn' : t_fn, 't_rig' : t_rig,
+                      'speedup' : t_fn / t_rig}]
+
+    return pd.DataFrame(rows)
+
+
+def _get_git_commit():
+    """
+    Returns the hash of the current git commit of this folder (None if not
+    available).
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _get_peak_memory(fn, *args):
+    """
+    Returns the peak memory [bytes] allocated during one call of the function
+    (measured with tracemalloc, separately from timing).
+    """
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    mem_start = tracemalloc.get_traced_memory()[0]
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1] - mem_start
+    if not was_tracing:
+        tracemalloc.stop()
+
+    return peak
+
+
+def _time_fn(fn, *args):
+    """
+    Returns the wall time [s] of one call of the function.
+    """
+    t_start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - t_start
+
+
+def _widest_region_regionprops(im_clustered):
+    """
+    Original method of measure_stream_width for finding the widest region by
+    looping over the regions in regionprops (used as reference).
+    """
+    im_labeled = skimage.measure.label(im_clustered)
+    width_max = 0
+    label = -1
+    for region in skimage.measure.regionprops(im_labeled):
+        row_min, col_min, row_max, col_max = region.bbox
+        width = col_max - col_min
+        if width > width_max:
+            label = region.label
+            width_max = width
+    assert label >= 0, "'label'=-1', no labeled regions found in k-means clustering."
+
+    return im_labeled == label
+
+
+if __name__ == '__main__':
+    print(bench_widest_region())
+    run_benchmarks(resolutions=RESOLUTIONS[:2])
@@ -9,7 +9,16 @@ metadata.
 """
 
 import glob
+import hashlib
+import json
 import os
+import pickle as pkl
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+import video
 
 
 def get_filepaths(path, template):
@@ -34,3 +43,432 @@ def get_filepaths(path, template):
     return file_list
 
 
+def cache_im_stack(im_path_list, cache_path):
+    """
+    Decodes a sequence of images once into a memory-mapped stack on disk so
+    that later runs read the frames without decoding them again. A sidecar
+    index stores the filepath, modification time, and size of each image; on
+    later calls, images that changed, were added, or were removed are
+    detected and only those images are decoded again.
+
+    All images must have the same shape and data type.
+
+    Parameters:
+        im_path_list : array-like
+            Sequence of filepaths to the images (e.g., from get_filepaths)
+        cache_path : string
+            Path to the cache without extension; the stack is saved as
+            cache_path + ".npy" and the index as cache_path + ".json"
+
+    Returns:
+        frames : video.ArraySource
+            Read-only frames of the memory-mapped stack keyed by filepath,
+            which can be passed to improc.proc_im_seq
+    """
+    im_path_list = list(im_path_list)
+    npy_path = cache_path + '.npy'
+    index_path = cache_path + '.json'
+    # signature of each image to detect changes
+    files = [_get_file_signature(im_path) for im_path in im_path_list]
+    # load the index and stack of an existing cache
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        old_stack = np.load(npy_path, mmap_mode='r')
+        old_files = {file[0] : (i, file) for i, file in enumerate(index['files'])}
+    except (OSError, ValueError, KeyError):
+        index = None
+        old_stack = None
+        old_files = {}
+    # return the existing cache if nothing changed
+    if index is not None and index['files'] == files:
+        return video.ArraySource(old_stack, im_path_list)
+    # get the shape and type of the frames from the first image
+    if len(im_path_list) == 0:
+        raise ValueError("No images given to cache.")
+    if old_files.get(files[0][0], (None, None))[1] == files[0]:
+        shape, dtype = old_stack.shape[1:], old_stack.dtype
+    else:
+        im = plt.imread(im_path_list[0])
+        shape, dtype = im.shape, im.dtype
+    # write the new stack to a temporary file, copying unchanged frames
+    tmp_path = cache_path + '.tmp.npy'
+    stack = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                      shape=(len(files),) + tuple(shape))
+    for i, file in enumerate(files):
+        i_old, old_file = old_files.get(file[0], (None, None))
+        if old_file == file:
+            stack[i] = old_stack[i_old]
+            continue
+        im = plt.imread(file[0])
+        if im.shape != tuple(shape) or im.dtype != dtype:
+            del stack
+            os.remove(tmp_path)
+            raise ValueError("{0} has shape {1} and type {2}, not {3} {4}."
+                             .format(file[0], im.shape, im.dtype, shape, dtype))
+        stack[i] = im
+    stack.flush()
+    del stack, old_stack
+    # replace the old cache with the new one
+    os.replace(tmp_path, npy_path)
+    with open(index_path, 'w') as f:
+        json.dump({'shape' : list(shape), 'dtype' : str(dtype),
+                   'files' : files}, f)
+
+    return video.ArraySource(np.load(npy_path, mmap_mode='r'), im_path_list)
+
+
+class ResultCache:
+    """
+    Persistent cache of the results of processing images, used by
+    improc.proc_im_seq(..., cache_dir=...) to only process images that are
+    new or changed. Results are stored in one file per processing function
+    and hash of parameters in the cache folder, keyed by the filepath,
+    modification time, and size of each image (or a hash of its contents).
+    """
+
+    def __init__(self, cache_dir, proc_fn, params, hash_content=False,
+                 max_age=None, max_size=None, skip_keys=()):
+        """
+        Parameters:
+            cache_dir : string
+                Folder to store the cache in (created if it does not exist)
+            proc_fn : function handle
+                Function used to process the images
+            params : list
+                Parameters of the processing function (hashed with
+                hash_params, so arrays like the brightfield are included)
+            hash_content : bool, optional
+                If True, images are identified by a hash of their contents
+                instead of their modification time and size
+            max_age : float, optional
+                Results (and cache files) not used for this long are
+                removed [s]
+            max_size : int, optional
+                Largest total size of the cache folder; the least recently
+                used cache files are removed beyond this size [bytes]
+            skip_keys : tuple of strings, optional
+                Keys of dictionaries in params to leave out of the hash
+        """
+        self.cache_dir = cache_dir
+        self.hash_content = hash_content
+        self.max_age = max_age
+        self.max_size = max_size
+        fn_name = '{0}.{1}'.format(proc_fn.__module__, proc_fn.__qualname__)
+        key = hashlib.sha1((fn_name + hash_params(params, skip_keys))
+                           .encode()).hexdigest()
+        self.cache_path = os.path.join(cache_dir, key + '.pkl')
+        # signatures of files that have already been read (or hashed)
+        self._signatures = {}
+        try:
+            with open(self.cache_path, 'rb') as f:
+                self.entries = pkl.load(f)
+        except (OSError, EOFError, pkl.UnpicklingError):
+            self.entries = {}
+
+    def get_signature(self, file):
+        """
+        Returns the signature of the frame stored in the given file.
+
+        Parameters:
+            file : tuple
+                (filepath, index in file) of the frame
+
+        Returns:
+            signature : tuple
+                Filepath, index, and either modification time and size or
+                hash of the contents of the file (None if the file cannot be
+                read)
+        """
+        filepath, i = file
+        if filepath not in self._signatures:
+            try:
+                if self.hash_content:
+                    # read in chunks so large files (e.g., videos) are not
+                    # loaded into memory at once
+                    h = hashlib.sha1()
+                    with open(filepath, 'rb') as f:
+                        for chunk in iter(lambda: f.read(2**20), b''):
+                            h.update(chunk)
+                    self._signatures[filepath] = (h.hexdigest(),)
+                else:
+                    self._signatures[filepath] = \
+                        tuple(_get_file_signature(filepath)[1:])
+            except OSError:
+                self._signatures[filepath] = None
+        if self._signatures[filepath] is None:
+            return None
+        return (filepath, i) + self._signatures[filepath]
+
+    def get(self, file, default=None):
+        """
+        Returns the cached result of the frame stored in the given file
+        ((filepath, index in file)) or default if it is not cached.
+        """
+        signature = self.get_signature(file)
+        entry = self.entries.get(signature) if signature else None
+        if entry is None:
+            return default
+        # record when the result was last used
+        entry[1] = time.time()
+        return entry[0]
+
+    def set(self, file, result):
+        """
+        Stores the result of the frame stored in the given file.
+        """
+        signature = self.get_signature(file)
+        if signature is not None:
+            self.entries[signature] = [result, time.time()]
+
+    def save(self):
+        """
+        Saves the cache, removing results and files that are too old and the
+        least recently used files if the folder is too large.
+        """
+        if self.max_age is not None:
+            t_min = time.time() - self.max_age
+            self.entries = {signature : entry for signature, entry
+                            in self.entries.items() if entry[1] >= t_min}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.cache_path, 'wb') as f:
+            pkl.dump(self.entries, f)
+        evict_result_cache(self.cache_dir, max_age=self.max_age,
+                           max_size=self.max_size, keep=[self.cache_path])
+
+
+class ProfileStore:
+    """
+    Append-only store of the per-column width profile of each frame (see
+    measure_stream_width with opts['profile']), e.g., to analyze the wobble
+    of the stream along the capillary without processing the images again.
+    Profiles are saved as rows of float32 in a raw binary file that is
+    appended to and read as a memory-mapped array, so a range of frames can
+    be sliced without loading the rest. Frame keys (e.g., filepaths) are
+    appended to a JSON-lines index. 100k frames of a 1920-column video take
+    about 770 MB.
+
+    The store is a folder with the files:
+        meta.json : number of columns and data type
+        profiles.bin : profiles as rows of float32
+        keys.jsonl : key of each profile, one per line
+
+    Example:
+        store = ProfileStore('profiles')
+        improc.proc_im_seq(im_path_list, improc.measure_stream_width,
+                           [um_per_pix, bf, {'profile' : True}],
+                           profile_store=store)
+        widths = store[1000:2000]
+    """
+
+    def __init__(self, path, n_cols=None):
+        """
+        Parameters:
+            path : string
+                Folder of the store (created if it does not exist). Profiles
+                are appended to an existing store.
+            n_cols : int, optional
+                Number of columns of each profile. Read from an existing store
+                or set by the first profile appended if not given.
+        """
+        self.path = path
+        self.dtype = np.dtype('float32')
+        self._bin_path = os.path.join(path, 'profiles.bin')
+        self._keys_path = os.path.join(path, 'keys.jsonl')
+        self._meta_path = os.path.join(path, 'meta.json')
+        self.n_cols = n_cols
+        self.keys = []
+        # open files for appending and memory map of the profiles for reading
+        self._bin_file = None
+        self._keys_file = None
+        self._mmap = None
+        if os.path.isfile(self._meta_path):
+            with open(self._meta_path, 'r') as f:
+                meta = json.load(f)
+            if n_cols is not None and n_cols != meta['n_cols']:
+                raise ValueError("Store {0} has {1} columns, not {2}."
+                                 .format(path, meta['n_cols'], n_cols))
+            self.n_cols = meta['n_cols']
+            with open(self._keys_path, 'r') as f:
+                self.keys = [json.loads(line) for line in f if line.strip()]
+            # drop a partially written profile (e.g., if a run was killed)
+            row_size = self.n_cols*self.dtype.itemsize
+            bin_size = os.path.getsize(self._bin_path)
+            n = min(bin_size // row_size, len(self.keys))
+            if bin_size != n*row_size or n < len(self.keys):
+                with open(self._bin_path, 'r+b') as f:
+                    f.truncate(n*row_size)
+                self.keys = self.keys[:n]
+                with open(self._keys_path, 'w') as f:
+                    f.writelines(json.dumps(key) + '\n' for key in self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, i):
+        """
+        Returns the profiles of the frames selected by an index or slice (as
+        a view of the memory-mapped file for slices).
+        """
+        return self.get_array()[i]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, key, profile):
+        """
+        Appends the profile of a frame to the end of the store.
+
+        Parameters:
+            key : string or int
+                Key of the frame (e.g., filepath or frame index)
+            profile : 1D array
+                Width of the stream in each column
+        """
+        profile = np.asarray(profile, dtype=self.dtype)
+        if self.n_cols is None:
+            self.n_cols = len(profile)
+        if profile.shape != (self.n_cols,):
+            raise ValueError("Profile has shape {0}, not ({1},)."
+                             .format(profile.shape, self.n_cols))
+        if self._bin_file is None:
+            self._open()
+        self._bin_file.write(profile.tobytes())
+        self._keys_file.write(json.dumps(key) + '\n')
+        self.keys.append(key)
+
+    def flush(self):
+        """
+        Writes appended profiles to disk.
+        """
+        if self._bin_file is not None:
+            self._bin_file.flush()
+            self._keys_file.flush()
+
+    def close(self):
+        """
+        Writes appended profiles to disk and closes the files (they are
+        reopened if more profiles are appended).
+        """
+        if self._bin_file is not None:
+            self._bin_file.close()
+            self._keys_file.close()
+            self._bin_file = None
+            self._keys_file = None
+
+    def get_array(self):
+        """
+        Returns all profiles as a read-only memory-mapped array with one row
+        per frame (empty if nothing has been appended).
+        """
+        self.flush()
+        if len(self) == 0:
+            return np.empty((0, self.n_cols or 0), dtype=self.dtype)
+        # map the file again if profiles were appended since it was mapped
+        if self._mmap is None or len(self._mmap) != len(self):
+            self._mmap = np.memmap(self._bin_path, dtype=self.dtype, mode='r',
+                                   shape=(len(self), self.n_cols))
+        return self._mmap
+
+    def read(self, start=0, stop=None):
+        """
+        Returns (keys, profiles) of the frames from start up to (not
+        including) stop, with the profiles as a view of the memory-mapped
+        file.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        return self.keys[start:stop], self.get_array()[start:stop]
+
+    def _open(self):
+        """
+        Creates the store if necessary and opens its files for appending.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        if not os.path.isfile(self._meta_path):
+            with open(self._meta_path, 'w') as f:
+                json.dump({'n_cols' : self.n_cols, 'dtype' : str(self.dtype)},
+                          f)
+        self._bin_file = open(self._bin_path, 'ab')
+        self._keys_file = open(self._keys_path, 'a')
+
+
+def evict_result_cache(cache_dir, max_age=None, max_size=None, keep=()):
+    """
+    Removes cache files of ResultCache that have not been used for longer
+    than max_age [s] and then the least recently used files until the folder
+    is no larger than max_size [bytes].
+
+    Parameters:
+        cache_dir : string
+            Folder of the cache
+        max_age : float, optional
+            Largest time since a cache file was last saved [s]
+        max_size : int, optional
+            Largest total size of the cache files [bytes]
+        keep : list of strings, optional
+            Paths of cache files not to remove
+    """
+    # cache files ordered from most to least recently saved
+    cache_files = [(os.path.getmtime(filepath), os.path.getsize(filepath),
+                    filepath) for filepath
+                   in glob.glob(os.path.join(cache_dir, '*.pkl'))]
+    cache_files.sort(reverse=True)
+    t_min = time.time() - max_age if max_age is not None else -np.inf
+    total_size = 0
+    for mtime, size, filepath in cache_files:
+        total_size += size
+        if filepath in keep:
+            continue
+        if mtime < t_min or (max_size is not None and total_size > max_size):
+            os.remove(filepath)
+            total_size -= size
+
+
+def hash_params(params, skip_keys=()):
+    """
+    Returns a hash of parameters made of (nested) lists, tuples,
+    dictionaries, arrays, and other objects with a fixed representation
+    (numbers, strings, None).
+
+    Parameters:
+        params : object
+            Parameters to hash
+        skip_keys : tuple of strings, optional
+            Keys of dictionaries to leave out of the hash
+
+    Returns:
+        params_hash : string
+            Hexadecimal SHA-1 hash of the parameters
+    """
+    h = hashlib.sha1()
+    def update(obj):
+        """Adds the object to the hash."""
+        if isinstance(obj, np.ndarray):
+            h.update('array{0}{1}'.format(obj.dtype, obj.shape).encode())
+            h.update(np.ascontiguousarray(obj).tobytes())
+        elif isinstance(obj, (list, tuple)):
+            h.update('{0}{1}'.format(type(obj).__name__, len(obj)).encode())
+            for item in obj:
+                update(item)
+        elif isinstance(obj, dict):
+            keys = sorted(key for key in obj if key not in skip_keys)
+            h.update('dict{0}'.format(len(keys)).encode())
+            for key in keys:
+                update(key)
+                update(obj[key])
+        else:
+            h.update(repr(obj).encode())
+    update(params)
+
+    return h.hexdigest()
+
+
+def _get_file_signature(filepath):
+    """
+    Returns [filepath, modification time (ns), size (bytes)] of a file.
+    """
+    stat = os.stat(filepath)
+    return [filepath, stat.st_mtime_ns, stat.st_size]
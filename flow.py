@@ -6,11 +6,19 @@ These functions define mathematical functions that compute properties of
 flowing streams such as flow rate, pressure, flow speed, and radius (for sheath
 flows).
 
+All functions accept scalars or NumPy arrays, which are broadcast against
+each other (e.g., an array of inner stream radii against a column of pressure
+drops), and do not modify the arrays given.
+
 @author: Andy
 """
 
+import functools
+
 import numpy as np
 
+import flownet
+
 
 def compute_average_stream_width():
     """
@@ -57,18 +65,18 @@ def get_flow_rates_ri_dp(eta, r_i, dp, r_obs_cap=250, l_obs_cap=10):
         Q_o = flow rate of outer stream in mL/min
     """
     # convert to SI
-    r_i /= 1E6 # um -> m
-    dp *= 1E5 # bar -> Pa
-    r_obs_cap /= 1E6 # um -> m
-    l_obs_cap /= 100 # cm -> m    
+    r_i = r_i / 1E6 # um -> m
+    dp = dp * 1E5 # bar -> Pa
+    r_obs_cap = r_obs_cap / 1E6 # um -> m
+    l_obs_cap = l_obs_cap / 100 # cm -> m
 
     # compute flow rates [m^3/s]
     Q_i = np.pi*dp*r_i**2/(4*eta*l_obs_cap)*(r_obs_cap**2 - 0.5*r_i**2)
     Q_o = np.pi*r_obs_cap**4/(8*eta*l_obs_cap)*dp - Q_i
 
     # convert units to uL/min
-    Q_i *= 60E9
-    Q_o *= 60E9
+    Q_i = Q_i * 60E9
+    Q_o = Q_o * 60E9
 
     return Q_i, Q_o
 
@@ -80,8 +88,8 @@ def get_flow_rates(eta, p_i=None, Q_i=None, p_o=None, Q_o=None, l_obs_cap=10,
     Assumes uniform viscosity, Newtonian fluids, and outlet to atmospheric
     pressure.
 
-    Equations were solved using Mathematica, the results of which can be found
-    in the file "flow_p_q_eqns" in the same folder as this file ("Calculations").
+    Solved with the network model of the sheath flow (see
+    flownet.get_sheath_network).
 
     inputs:
         eta         :   viscosity of fluid [Pa.s]
@@ -108,70 +116,22 @@ def get_flow_rates(eta, p_i=None, Q_i=None, p_o=None, Q_o=None, l_obs_cap=10,
     assert (p_i is None) != (Q_i is None), "Provide only one: p_i or Q_i."
     assert (p_o is None) != (Q_o is None), "Provide only one: p_o or Q_o."
 
-    # CONVERT TO SI
-    l_obs_cap /= 100 # cm -> m
-    r_obs_cap /= 1E6 # um -> m
-    l_inner_cap /= 100 # cm -> m
-    r_inner_cap /= 1E6 # um -> m
-    l_tube_i /= 100 # cm -> m
-    r_tube_i /= 1E6 # um -> m
-    l_tube_o /= 100 # cm -> m
-    r_tube_o /= 1E6 # um -> m
-
-    # inner and outer pressures given
-    if (p_i is not None) and (p_o is not None):
-        # CONVERT TO SI
-        p_i *= 1E5 # bar -> Pa
-        p_o *= 1E5 # bar -> Pa
-
-        # Calculate flow rates
-        num_Q_i = np.pi*r_tube_i**4*r_inner_cap**4*(l_obs_cap*(p_i - p_o)* \
-                    r_tube_o**4 + l_tube_o*p_i*r_obs_cap**4)
-        num_Q_o = np.pi*r_tube_o**4*(l_obs_cap*(p_o - p_i)*r_tube_i**4*\
-                    r_inner_cap**4 + p_o*(l_inner_cap*r_tube_i**4 + \
-                    l_tube_i*r_inner_cap**4)*r_obs_cap**4)
-        denom = (8*eta*(l_inner_cap*r_tube_i**4* \
-                (l_obs_cap*r_tube_o**4 + l_tube_o*r_obs_cap**4) + \
-                r_inner_cap**4*(l_tube_o*l_obs_cap*r_tube_i**4 + \
-                l_tube_i*l_obs_cap*r_tube_o**4 + \
-                l_tube_i*l_tube_o*r_obs_cap**4)))
-        Q_i = num_Q_i / denom
-        Q_o = num_Q_o / denom
-
-    # given inner stream pressure and outer stream flow rate
-    elif (p_i is not None) and (Q_o is not None):
-        # CONVERT TO SI
-        p_i *= 1E5
-        Q_o /= 60E9
-
-        # calculate the flow rate of the inner stream [m^3/s]
-        Q_i = (r_tube_i**4*r_inner_cap**4*(p_i*np.pi*r_obs_cap**4 - \
-                8*l_obs_cap*Q_o*eta)) / \
-                (8*eta*(l_obs_cap*r_tube_i**4*r_inner_cap**4 + \
-                (l_inner_cap*r_tube_i**4 + l_tube_i*r_inner_cap**4)*r_obs_cap**4))
-
-    # given inner stream flow rate and outer stream pressure
-    elif (Q_i is not None) and (p_o is not None):
-        # CONVERT TO SI
-        Q_i /= 60E9
-        p_o *= 1E5
-
-        # calculate the flow rate of the outer stream [m^3/s]
-        Q_o = (p_o*np.pi*r_tube_o**4 - 8*eta*l_obs_cap*(r_tube_o/r_obs_cap)**4*Q_i) / \
-                (8*eta*(l_obs_cap*(r_tube_o/r_obs_cap)**4 + l_tube_o))
-
-    elif (Q_i is not None) and (Q_o is not None):
-        # CONVERT TO SI
-        Q_i /= 60E9
-        Q_o /= 60E9
+    net = _get_sheath_network(l_obs_cap, r_obs_cap, l_inner_cap,
+                    r_inner_cap, l_tube_i, r_tube_i, l_tube_o, r_tube_o)
+    # outlet to atmospheric pressure (gauge pressure of 0)
+    pressures = {'outlet' : 0}
+    flows = {}
+    if p_i is not None:
+        pressures['source_i'] = p_i
     else:
-        print("'if' statements failed to elicit a true response.")
-
-    # CONVERT FROM M^3/S -> UL/MIN
-    Q_i *= 60E9
-    Q_o *= 60E9
+        flows['source_i'] = Q_i
+    if p_o is not None:
+        pressures['source_o'] = p_o
+    else:
+        flows['source_o'] = Q_o
+    p, Q = net.solve(pressures, flows, eta=eta)
 
-    return Q_i, Q_o
+    return _broadcast(Q['tube_i'], Q['tube_o'])
 
 def test_get_flow_rates():
     """
@@ -213,10 +173,53 @@ def test_get_flow_rates():
 
     return
 
+def test_flow_network(n=1000, seed=0):
+    """
+    Tests that get_flow_rates and get_pressures (solved with the network
+    model) agree with the closed-form solutions for random parameters in
+    every combination of given pressures and flow rates.
+    """
+    rng = np.random.default_rng(seed)
+    eta = rng.uniform(0.1, 2, n)
+    geometry = {'l_obs_cap' : rng.uniform(5, 20, n),
+                'r_obs_cap' : rng.uniform(100, 300, n),
+                'l_inner_cap' : rng.uniform(1, 5, n),
+                'r_inner_cap' : rng.uniform(100, 300, n),
+                'l_tube_i' : rng.uniform(10, 50, n),
+                'r_tube_i' : rng.uniform(200, 500, n),
+                'l_tube_o' : rng.uniform(10, 50, n),
+                'r_tube_o' : rng.uniform(200, 500, n)}
+    p_i = rng.uniform(10, 20, n)
+    p_o = rng.uniform(5, 10, n)
+    Q_i, Q_o = _get_flow_rates_closed_form(eta, p_i=p_i, p_o=p_o, **geometry)
+    cases = {'p_i, p_o' : {'p_i' : p_i, 'p_o' : p_o},
+             'p_i, Q_o' : {'p_i' : p_i, 'Q_o' : Q_o},
+             'Q_i, p_o' : {'Q_i' : Q_i, 'p_o' : p_o},
+             'Q_i, Q_o' : {'Q_i' : Q_i, 'Q_o' : Q_o}}
+    for case, kwargs in cases.items():
+        result = np.array(get_flow_rates(eta, **kwargs, **geometry))
+        expected = np.array(_get_flow_rates_closed_form(eta, **kwargs,
+                                                        **geometry))
+        err = np.max(np.abs(result - expected) / np.abs(expected))
+        print("get_flow_rates given {case}: max relative error {err:.1e}"
+              .format(case=case, err=err))
+        assert np.allclose(result, expected, rtol=1E-9), case
+    result = np.array(get_pressures(eta, Q_i, Q_o, **geometry))
+    expected = np.array(_get_pressures_closed_form(eta, Q_i, Q_o, **geometry))
+    err = np.max(np.abs(result - expected) / np.abs(expected))
+    print("get_pressures: max relative error {err:.1e}".format(err=err))
+    assert np.allclose(result, expected, rtol=1E-9)
+
+    return
+
 def get_pressures(eta, Q_i, Q_o, l_obs_cap=10,
     r_obs_cap=250, l_inner_cap=2.3, r_inner_cap=280, l_tube_i=20,
     r_tube_i=481.25, l_tube_o=20, r_tube_o=481.25):
     """
+    Gives the pressures along the sheath flow given the flow rates, solved
+    with the network model of the sheath flow (see
+    flownet.get_sheath_network).
+
     inputs:
         eta         :   viscosity of fluid [Pa.s]
         Q_i         :   flow rate of inner stream [uL/min]
@@ -239,31 +242,12 @@ def get_pressures(eta, Q_i, Q_o, l_obs_cap=10,
         p_obs_cap   :   pressure at inlet to observation capillary [bar]
                                 *assumes no pressure drop down microfluidic device
     """
-    # CONVERT TO SI
-    Q_i /= 60E9 # uL/min -> m^3/s
-    Q_o /= 60E9 # uL/min -> m^3/s
-    l_obs_cap /= 100 # cm -> m
-    r_obs_cap /= 1E6 # um -> m
-    l_inner_cap /= 100 # cm -> m
-    r_inner_cap /= 1E6 # um -> m
-    l_tube_i /= 100 # cm -> m
-    r_tube_i /= 1E6 # um -> m
-    l_tube_o /= 100 # cm -> m
-    r_tube_o /= 1E6 # um -> m
-
-    # compute pressures using Poiseuille flow pressure drop starting from end
-    p_obs_cap = 8*eta*l_obs_cap/(np.pi*r_obs_cap**4)*(Q_i+Q_o)
-    p_inner_cap = p_obs_cap + 8*eta*l_inner_cap/(np.pi*r_inner_cap**4)*Q_i
-    p_o = p_obs_cap + 8*eta*l_tube_o/(np.pi*r_tube_o**4)*Q_o
-    p_i = p_inner_cap + 8*eta*l_tube_i/(np.pi*r_tube_i**4)*Q_i
+    net = _get_sheath_network(l_obs_cap, r_obs_cap, l_inner_cap,
+                    r_inner_cap, l_tube_i, r_tube_i, l_tube_o, r_tube_o)
+    p, Q = net.solve({'outlet' : 0}, {'source_i' : Q_i, 'source_o' : Q_o},
+                     eta=eta)
 
-    # convert from Pa to bar
-    p_obs_cap /= 1E5
-    p_inner_cap /= 1E5
-    p_o /= 1E5
-    p_i /= 1E5
-
-    return p_i, p_o, p_inner_cap, p_obs_cap
+    return p['source_i'], p['source_o'], p['inner_cap'], p['obs_cap']
 
 
 def get_inner_stream_radius(Q_i, Q_o, r_obs_cap=250):
@@ -297,20 +281,369 @@ def get_velocity(Q_i, Q_o, r_obs_cap=250):
         r_obs_cap   :   inner radius of observation capilary [um]
 
     returns:
-        v_center    :   velocity at center of inner stream [m/s]
+        v_center    :   velocity at center of inner stream [cm/s]
     """
     # CONVERT TO SI
-    Q_i /= 60E9 # uL/min -> m^3/s
-    Q_o /= 60E9 # uL/min -> m^3/s
-    r_obs_cap /= 1E6 # um -> m
+    Q_i = Q_i / 60E9 # uL/min -> m^3/s
+    Q_o = Q_o / 60E9 # uL/min -> m^3/s
+    r_obs_cap = r_obs_cap / 1E6 # um -> m
 
     # maximum velocity in exit capillary [m/s]
     v_center = 2*(Q_o+Q_i)/(np.pi*r_obs_cap**2)
     # convert m/s -> cm/s
-    v_center *= 100
+    v_center = v_center * 100
 
     return v_center
 
+def get_setpoints(eta, r_i, dp=None, v_center=None, Q_tot=None, l_obs_cap=10,
+    r_obs_cap=250, l_inner_cap=2.3, r_inner_cap=280, l_tube_i=20,
+    r_tube_i=481.25, l_tube_o=20, r_tube_o=481.25):
+    """
+    Computes the pump pressures and flow rates needed to reach the target
+    radius of the inner stream together with one target for the total flow
+    through the observation capillary: its pressure drop (dp), the velocity
+    at the center of the stream (v_center), or the total flow rate (Q_tot).
+    Inverts get_inner_stream_radius, get_velocity, and get_flow_rates_ri_dp
+    in closed form, so arrays of targets are solved in one vectorized pass.
+
+    Assumes Newtonian fluids with the same viscosity.
+
+    inputs:
+        eta         :   viscosity of fluid [Pa.s]
+        r_i         :   target radius of the inner stream [um]
+        dp          :   target pressure drop down the observation capillary
+                            [bar]
+        v_center    :   target velocity at center of inner stream [cm/s]
+        Q_tot       :   target total flow rate [uL/min]
+        l_obs_cap, r_obs_cap, l_inner_cap, r_inner_cap, l_tube_i, r_tube_i,
+        l_tube_o, r_tube_o : geometry (see get_flow_rates)
+
+    returns:
+        p_i         :   pressure at source of inner stream [bar]
+        p_o         :   pressure at source of outer stream [bar]
+        Q_i         :   flow rate of inner stream [uL/min]
+        Q_o         :   flow rate of outer stream [uL/min]
+    """
+    # ensure that exactly one target of the total flow is given
+    assert sum(x is not None for x in (dp, v_center, Q_tot)) == 1, \
+        "Provide only one: dp, v_center, or Q_tot."
+    assert np.all(np.asarray(r_i) <= np.asarray(r_obs_cap)), \
+        "Inner stream must be narrower than the observation capillary."
+
+    # total flow rate through the observation capillary [uL/min]
+    if dp is not None:
+        # Poiseuille flow, same as Q_i + Q_o from get_flow_rates_ri_dp
+        Q_tot = np.pi*(r_obs_cap/1E6)**4*(dp*1E5)/(8*eta*l_obs_cap/100)*60E9
+    elif v_center is not None:
+        # inverts get_velocity (cm/s -> m/s, m^3/s -> uL/min)
+        Q_tot = np.pi*(r_obs_cap/1E6)**2*(v_center/100)/2*60E9
+    # split of the flow that gives the inner stream radius (inverts equation
+    # A.14 in candidacy report, see get_inner_stream_radius)
+    Q_o = Q_tot*(1 - (r_i/r_obs_cap)**2)**2
+    Q_i = Q_tot - Q_o
+    p_i, p_o, p_inner_cap, p_obs_cap = get_pressures(eta, Q_i, Q_o,
+                    l_obs_cap=l_obs_cap, r_obs_cap=r_obs_cap,
+                    l_inner_cap=l_inner_cap, r_inner_cap=r_inner_cap,
+                    l_tube_i=l_tube_i, r_tube_i=r_tube_i, l_tube_o=l_tube_o,
+                    r_tube_o=r_tube_o)
+
+    return p_i, p_o, Q_i, Q_o
+
+class Rig:
+    """
+    Fixed geometry of the sheath-flow rig (see get_flow_rates for the
+    parameters), with the hydraulic resistances of its segments (per unit
+    viscosity) and the denominators of the solutions precomputed in SI
+    units. Use its methods instead of the functions of this module in loops
+    over pressures or flow rates with the same tubing. Rigs cannot be
+    changed after they are created and can be used as keys of dictionaries.
+
+    Example:
+        rig = Rig(l_tube_i=45, l_tube_o=50)
+        Q_i, Q_o = rig.get_flow_rates(1.412, p_i=12, p_o=10)
+    """
+
+    # names of the geometry parameters (in the order of get_flow_rates)
+    GEOMETRY = ('l_obs_cap', 'r_obs_cap', 'l_inner_cap', 'r_inner_cap',
+                'l_tube_i', 'r_tube_i', 'l_tube_o', 'r_tube_o')
+    __slots__ = GEOMETRY + ('_R_obs', '_R_inner_cap', '_R_tube_i',
+                            '_R_tube_o', '_R_i', '_R_i_obs', '_R_o_obs',
+                            '_denom', '_A_obs')
+
+    def __init__(self, l_obs_cap=10, r_obs_cap=250, l_inner_cap=2.3,
+                 r_inner_cap=280, l_tube_i=20, r_tube_i=481.25, l_tube_o=20,
+                 r_tube_o=481.25):
+        # attributes are set with object.__setattr__ since the rig is
+        # immutable
+        set_attr = lambda name, val: object.__setattr__(self, name, val)
+        for name, val in zip(self.GEOMETRY, (l_obs_cap, r_obs_cap,
+                             l_inner_cap, r_inner_cap, l_tube_i, r_tube_i,
+                             l_tube_o, r_tube_o)):
+            set_attr(name, float(val))
+        # resistance 8*l/(pi*r^4) per unit viscosity [1/m^3] (cm, um -> m)
+        R = lambda l, r: 8*(l/100)/(np.pi*(r/1E6)**4)
+        set_attr('_R_obs', R(l_obs_cap, r_obs_cap))
+        set_attr('_R_inner_cap', R(l_inner_cap, r_inner_cap))
+        set_attr('_R_tube_i', R(l_tube_i, r_tube_i))
+        set_attr('_R_tube_o', R(l_tube_o, r_tube_o))
+        # resistance from the inner source to the observation capillary
+        set_attr('_R_i', self._R_tube_i + self._R_inner_cap)
+        # sums and products shared by the solutions
+        set_attr('_R_i_obs', self._R_i + self._R_obs)
+        set_attr('_R_o_obs', self._R_tube_o + self._R_obs)
+        set_attr('_denom', self._R_i*self._R_tube_o + \
+                           self._R_i*self._R_obs + self._R_tube_o*self._R_obs)
+        # cross-sectional area of the observation capillary [m^2]
+        set_attr('_A_obs', np.pi*(r_obs_cap/1E6)**2)
+
+    def __setattr__(self, name, val):
+        raise AttributeError("Rig is immutable; create a new one.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Rig is immutable; create a new one.")
+
+    def __eq__(self, other):
+        return isinstance(other, Rig) and self.get_geometry() == \
+                other.get_geometry()
+
+    def __hash__(self):
+        return hash(tuple(self.get_geometry().values()))
+
+    def __repr__(self):
+        return 'Rig({0})'.format(', '.join('{0}={1!r}'.format(name, val)
+                            for name, val in self.get_geometry().items()))
+
+    def __reduce__(self):
+        # pickle by the geometry (e.g., to send to worker processes)
+        return (Rig, tuple(self.get_geometry().values()))
+
+    def get_geometry(self):
+        """
+        Returns the geometry parameters as a dictionary (keyword arguments of
+        the functions of this module).
+        """
+        return {name : getattr(self, name) for name in self.GEOMETRY}
+
+    def get_flow_rates(self, eta, p_i=None, Q_i=None, p_o=None, Q_o=None):
+        """
+        Same as get_flow_rates with the geometry of the rig.
+        """
+        assert (p_i is None) != (Q_i is None), "Provide only one: p_i or Q_i."
+        assert (p_o is None) != (Q_o is None), "Provide only one: p_o or Q_o."
+        # convert pressures [bar] to flow rates [uL/min] through a unit
+        # resistance [1/m^3] of fluid of unit viscosity [Pa.s]
+        c = 1E5*60E9
+        if p_i is not None and p_o is not None:
+            Q_i = c*(p_i*self._R_o_obs - p_o*self._R_obs)/(eta*self._denom)
+            Q_o = c*(p_o*self._R_i_obs - p_i*self._R_obs)/(eta*self._denom)
+        elif p_i is not None:
+            Q_i = (c*p_i/eta - Q_o*self._R_obs)/self._R_i_obs
+        elif p_o is not None:
+            Q_o = (c*p_o/eta - Q_i*self._R_obs)/self._R_o_obs
+
+        return _broadcast(Q_i, Q_o)
+
+    def get_pressures(self, eta, Q_i, Q_o):
+        """
+        Same as get_pressures with the geometry of the rig.
+        """
+        # convert eta*R*Q from Pa.s/m^3*uL/min to bar
+        c = eta/(1E5*60E9)
+        p_obs_cap = c*self._R_obs*(Q_i + Q_o)
+        p_inner_cap = p_obs_cap + c*self._R_inner_cap*Q_i
+        p_o = p_obs_cap + c*self._R_tube_o*Q_o
+        p_i = p_inner_cap + c*self._R_tube_i*Q_i
+
+        return p_i, p_o, p_inner_cap, p_obs_cap
+
+    def get_flow_rates_ri_dp(self, eta, r_i, dp):
+        """
+        Same as get_flow_rates_ri_dp with the geometry of the rig.
+        """
+        Q_tot = 1E5*60E9*dp/(eta*self._R_obs)
+        return self._split_flow(r_i, Q_tot)
+
+    def get_setpoints(self, eta, r_i, dp=None, v_center=None, Q_tot=None):
+        """
+        Same as get_setpoints with the geometry of the rig.
+        """
+        assert sum(x is not None for x in (dp, v_center, Q_tot)) == 1, \
+            "Provide only one: dp, v_center, or Q_tot."
+        if dp is not None:
+            Q_i, Q_o = self.get_flow_rates_ri_dp(eta, r_i, dp)
+        else:
+            if v_center is not None:
+                Q_tot = self._A_obs*(v_center/100)/2*60E9
+            Q_i, Q_o = self._split_flow(r_i, Q_tot)
+        p_i, p_o, _, _ = self.get_pressures(eta, Q_i, Q_o)
+
+        return p_i, p_o, Q_i, Q_o
+
+    def get_inner_stream_radius(self, Q_i, Q_o):
+        """
+        Same as get_inner_stream_radius with the geometry of the rig.
+        """
+        return get_inner_stream_radius(Q_i, Q_o, r_obs_cap=self.r_obs_cap)
+
+    def get_velocity(self, Q_i, Q_o):
+        """
+        Same as get_velocity with the geometry of the rig [cm/s].
+        """
+        return 2*(Q_i + Q_o)/60E9/self._A_obs*100
+
+    def _split_flow(self, r_i, Q_tot):
+        """
+        Splits the total flow rate into the inner and outer flow rates that
+        give an inner stream of radius r_i [um] (see get_setpoints).
+        """
+        assert np.all(np.asarray(r_i) <= self.r_obs_cap), \
+            "Inner stream must be narrower than the observation capillary."
+        Q_o = Q_tot*(1 - (r_i/self.r_obs_cap)**2)**2
+        return Q_tot - Q_o, Q_o
+
+def _get_flow_rates_closed_form(eta, p_i=None, Q_i=None, p_o=None, Q_o=None,
+    l_obs_cap=10, r_obs_cap=250, l_inner_cap=2.3, r_inner_cap=280, l_tube_i=20,
+    r_tube_i=481.25, l_tube_o=20, r_tube_o=481.25):
+    """
+    Closed-form solution of get_flow_rates for the sheath-flow network, kept
+    to verify the network solver (see test_flow_network).
+
+    Equations were solved using Mathematica, the results of which can be found
+    in the file "flow_p_q_eqns" in the same folder as this file ("Calculations").
+    """
+    # ensure that only one of pressure or flow rate is given
+    assert (p_i is None) != (Q_i is None), "Provide only one: p_i or Q_i."
+    assert (p_o is None) != (Q_o is None), "Provide only one: p_o or Q_o."
+
+    # CONVERT TO SI
+    l_obs_cap = l_obs_cap / 100 # cm -> m
+    r_obs_cap = r_obs_cap / 1E6 # um -> m
+    l_inner_cap = l_inner_cap / 100 # cm -> m
+    r_inner_cap = r_inner_cap / 1E6 # um -> m
+    l_tube_i = l_tube_i / 100 # cm -> m
+    r_tube_i = r_tube_i / 1E6 # um -> m
+    l_tube_o = l_tube_o / 100 # cm -> m
+    r_tube_o = r_tube_o / 1E6 # um -> m
+
+    # inner and outer pressures given
+    if (p_i is not None) and (p_o is not None):
+        # CONVERT TO SI
+        p_i = p_i * 1E5 # bar -> Pa
+        p_o = p_o * 1E5 # bar -> Pa
+
+        # Calculate flow rates
+        num_Q_i = np.pi*r_tube_i**4*r_inner_cap**4*(l_obs_cap*(p_i - p_o)* \
+                    r_tube_o**4 + l_tube_o*p_i*r_obs_cap**4)
+        num_Q_o = np.pi*r_tube_o**4*(l_obs_cap*(p_o - p_i)*r_tube_i**4*\
+                    r_inner_cap**4 + p_o*(l_inner_cap*r_tube_i**4 + \
+                    l_tube_i*r_inner_cap**4)*r_obs_cap**4)
+        denom = (8*eta*(l_inner_cap*r_tube_i**4* \
+                (l_obs_cap*r_tube_o**4 + l_tube_o*r_obs_cap**4) + \
+                r_inner_cap**4*(l_tube_o*l_obs_cap*r_tube_i**4 + \
+                l_tube_i*l_obs_cap*r_tube_o**4 + \
+                l_tube_i*l_tube_o*r_obs_cap**4)))
+        Q_i = num_Q_i / denom
+        Q_o = num_Q_o / denom
+
+    # given inner stream pressure and outer stream flow rate
+    elif (p_i is not None) and (Q_o is not None):
+        # CONVERT TO SI
+        p_i = p_i * 1E5
+        Q_o = Q_o / 60E9
+
+        # calculate the flow rate of the inner stream [m^3/s]
+        Q_i = (r_tube_i**4*r_inner_cap**4*(p_i*np.pi*r_obs_cap**4 - \
+                8*l_obs_cap*Q_o*eta)) / \
+                (8*eta*(l_obs_cap*r_tube_i**4*r_inner_cap**4 + \
+                (l_inner_cap*r_tube_i**4 + l_tube_i*r_inner_cap**4)*r_obs_cap**4))
+
+    # given inner stream flow rate and outer stream pressure
+    elif (Q_i is not None) and (p_o is not None):
+        # CONVERT TO SI
+        Q_i = Q_i / 60E9
+        p_o = p_o * 1E5
+
+        # calculate the flow rate of the outer stream [m^3/s]
+        Q_o = (p_o*np.pi*r_tube_o**4 - 8*eta*l_obs_cap*(r_tube_o/r_obs_cap)**4*Q_i) / \
+                (8*eta*(l_obs_cap*(r_tube_o/r_obs_cap)**4 + l_tube_o))
+
+    elif (Q_i is not None) and (Q_o is not None):
+        # CONVERT TO SI
+        Q_i = Q_i / 60E9
+        Q_o = Q_o / 60E9
+    else:
+        print("'if' statements failed to elicit a true response.")
+
+    # CONVERT FROM M^3/S -> UL/MIN
+    Q_i = Q_i * 60E9
+    Q_o = Q_o * 60E9
+
+    # a given flow rate does not depend on the other inputs, so broadcast
+    # both flow rates to the same shape
+    return _broadcast(Q_i, Q_o)
+
+def _get_pressures_closed_form(eta, Q_i, Q_o, l_obs_cap=10,
+    r_obs_cap=250, l_inner_cap=2.3, r_inner_cap=280, l_tube_i=20,
+    r_tube_i=481.25, l_tube_o=20, r_tube_o=481.25):
+    """
+    Closed-form solution of get_pressures for the sheath-flow network, kept
+    to verify the network solver (see test_flow_network).
+    """
+    # CONVERT TO SI
+    Q_i = Q_i / 60E9 # uL/min -> m^3/s
+    Q_o = Q_o / 60E9 # uL/min -> m^3/s
+    l_obs_cap = l_obs_cap / 100 # cm -> m
+    r_obs_cap = r_obs_cap / 1E6 # um -> m
+    l_inner_cap = l_inner_cap / 100 # cm -> m
+    r_inner_cap = r_inner_cap / 1E6 # um -> m
+    l_tube_i = l_tube_i / 100 # cm -> m
+    r_tube_i = r_tube_i / 1E6 # um -> m
+    l_tube_o = l_tube_o / 100 # cm -> m
+    r_tube_o = r_tube_o / 1E6 # um -> m
+
+    # compute pressures using Poiseuille flow pressure drop starting from end
+    p_obs_cap = 8*eta*l_obs_cap/(np.pi*r_obs_cap**4)*(Q_i+Q_o)
+    p_inner_cap = p_obs_cap + 8*eta*l_inner_cap/(np.pi*r_inner_cap**4)*Q_i
+    p_o = p_obs_cap + 8*eta*l_tube_o/(np.pi*r_tube_o**4)*Q_o
+    p_i = p_inner_cap + 8*eta*l_tube_i/(np.pi*r_tube_i**4)*Q_i
+
+    # convert from Pa to bar
+    p_obs_cap = p_obs_cap / 1E5
+    p_inner_cap = p_inner_cap / 1E5
+    p_o = p_o / 1E5
+    p_i = p_i / 1E5
+
+    return p_i, p_o, p_inner_cap, p_obs_cap
+
+
+def _broadcast(*vals):
+    """
+    Broadcasts the values to the same shape as new arrays (scalars are
+    returned as they are).
+    """
+    if all(np.ndim(val) == 0 for val in vals):
+        return vals
+    return tuple(np.array(val) for val in np.broadcast_arrays(*vals))
+
+
+def _get_sheath_network(*geometry):
+    """
+    Returns the network of the sheath flow for the geometry (in the order of
+    the arguments of flownet.get_sheath_network). Networks of scalar
+    geometries are cached so they keep their cached solutions between calls.
+    """
+    if all(np.ndim(val) == 0 for val in geometry):
+        return _get_sheath_network_cached(*[float(val) for val in geometry])
+    return flownet.get_sheath_network(*geometry)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_sheath_network_cached(*geometry):
+    """
+    Cached flownet.get_sheath_network for scalar geometries.
+    """
+    return flownet.get_sheath_network(*geometry)
+
 if __name__=='__main__':
     Q_i, Q_o = get_flow_rates_fixed_speed(20)
 
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:34:10 2026
+
+Propagates the uncertainty of the parameters of the sheath flow (radii and
+lengths of the capillaries and tubing, viscosity, and pump pressures or flow
+rates) to the flow rates, inner stream radius, and center velocity with a
+Monte Carlo simulation. Samples are drawn and pushed through the functions of
+flow in chunks, optionally in parallel processes, so 10^5 - 10^6 samples run
+in seconds.
+
+@author: Andy
+"""
+
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+
+import flow
+
+
+# parameters of flow.get_flow_rates that can be uncertain
+PARAMS = ('eta', 'p_i', 'Q_i', 'p_o', 'Q_o', 'l_obs_cap', 'r_obs_cap',
+          'l_inner_cap', 'r_inner_cap', 'l_tube_i', 'r_tube_i', 'l_tube_o',
+          'r_tube_o')
+# parameters that must be positive (the geometry and viscosity)
+POSITIVE = ('eta', 'l_obs_cap', 'r_obs_cap', 'l_inner_cap', 'r_inner_cap',
+            'l_tube_i', 'r_tube_i', 'l_tube_o', 'r_tube_o')
+# outputs computed for each sample
+OUTPUTS = ('Q_i', 'Q_o', 'r_i', 'v_center')
+# largest number of times non-physical draws are redrawn
+MAX_REDRAWS = 100
+
+
+def propagate_uncertainty(eta, p_i=None, Q_i=None, p_o=None, Q_o=None,
+                          tol=None, rel_tol=None, dist='normal',
+                          n_samples=10**5, chunk_size=10**5,
+                          percentiles=(2.5, 50, 97.5), workers=None, seed=0,
+                          return_samples=False, **geometry):
+    """
+    Estimates the distribution of the flow rates (flow.get_flow_rates), inner
+    stream radius (flow.get_inner_stream_radius), and velocity at the center
+    of the stream (flow.get_velocity) given the tolerances of the
+    parameters.
+
+    inputs:
+        eta, p_i, Q_i, p_o, Q_o : nominal viscosity, pressures, and flow
+                            rates (see flow.get_flow_rates)
+        tol         :   dictionary of absolute tolerances of parameters (see
+                            PARAMS) in the units of the parameter, e.g.,
+                            {'r_obs_cap' : 5, 'p_i' : 0.1}
+        rel_tol     :   dictionary of tolerances of parameters as fractions
+                            of their nominal values, e.g., {'eta' : 0.05}
+        dist        :   'normal' to draw parameters from normal distributions
+                            with the tolerance as standard deviation, or
+                            'uniform' to draw them uniformly within the
+                            tolerance of the nominal value. Draws of
+                            parameters that must be positive (POSITIVE) are
+                            redrawn until positive, i.e., the distributions
+                            are truncated at 0.
+        n_samples   :   number of samples
+        chunk_size  :   number of samples computed at once
+        percentiles :   percentiles of each output to report
+        workers     :   if given, chunks are computed in parallel by this
+                            number of processes (or this
+                            concurrent.futures.Executor)
+        seed        :   seed of the random samples (for the same seed and
+                            chunk_size, results do not depend on workers)
+        return_samples : if True, the outputs of every sample are returned too
+        geometry    :   nominal geometry (see flow.get_flow_rates)
+
+    returns:
+        bands       :   Pandas DataFrame indexed by output (OUTPUTS) with the
+                            nominal value, mean, standard deviation, and
+                            requested percentiles ([uL/min], [um], [cm/s])
+                            over the valid samples, and the fraction of
+                            samples that are valid. A sample is valid if
+                            all of its outputs are defined (e.g., r_i is not
+                            defined for a negative flow rate), so every
+                            output is described by the same samples.
+        samples     :   Pandas DataFrame of the outputs of each sample and
+                            whether it is valid ("valid") (if
+                            return_samples)
+    """
+    assert dist in ('normal', 'uniform'), \
+        "dist must be 'normal' or 'uniform', not '{0}'.".format(dist)
+    tol = {} if tol is None else tol
+    rel_tol = {} if rel_tol is None else rel_tol
+    nominal = dict(flow.Rig(**geometry).get_geometry(), eta=eta, p_i=p_i,
+                   Q_i=Q_i, p_o=p_o, Q_o=Q_o)
+    # absolute tolerance of each uncertain parameter
+    sigma = {}
+    for name, val in list(tol.items()) + \
+            [(name, val*np.abs(nominal.get(name) or 0))
+             for name, val in rel_tol.items()]:
+        assert name in PARAMS, "Unknown parameter {0}.".format(name)
+        assert nominal[name] is not None, \
+            "Parameter {0} is not given, so it has no tolerance.".format(name)
+        sigma[name] = val
+    # draw each chunk from its own random stream so the samples are the same
+    # however the chunks are computed
+    starts = range(0, n_samples, chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    tasks = [(nominal, sigma, dist, min(chunk_size, n_samples - start),
+              chunk_seed) for start, chunk_seed in zip(starts, seeds)]
+    if workers is None:
+        chunks = [_sample_chunk(*task) for task in tasks]
+    else:
+        own_pool = not isinstance(workers, concurrent.futures.Executor)
+        pool = concurrent.futures.ProcessPoolExecutor(workers) if own_pool \
+                else workers
+        try:
+            chunks = list(pool.map(_sample_chunk, *zip(*tasks)))
+        finally:
+            if own_pool:
+                pool.shutdown()
+    samples = {name : np.concatenate([chunk[name] for chunk in chunks])
+               for name in OUTPUTS}
+    # ignore samples without a solution (e.g., negative flow rate) for all
+    # outputs
+    valid = np.all([np.isfinite(samples[name]) for name in OUTPUTS], axis=0)
+    # point estimate with the nominal parameters
+    point = _compute_outputs(nominal)
+    rows = []
+    for name in OUTPUTS:
+        vals = samples[name][valid]
+        row = {'output' : name, 'nominal' : float(point[name]),
+               'mean' : np.mean(vals) if len(vals) > 0 else np.nan,
+               'std' : np.std(vals) if len(vals) > 0 else np.nan,
+               'frac_valid' : np.mean(valid)}
+        row.update({'p{0:g}'.format(q) : val for q, val in zip(percentiles,
+                    np.percentile(vals, percentiles) if len(vals) > 0
+                    else [np.nan]*len(percentiles))})
+        rows += [row]
+    bands = pd.DataFrame(rows).set_index('output')
+    if return_samples:
+        return bands, pd.DataFrame(dict(samples, valid=valid))
+
+    return bands
+
+
+def _sample_chunk(nominal, sigma, dist, n, seed):
+    """
+    Draws n samples of the uncertain parameters and returns the outputs of
+    each sample as a dictionary of arrays.
+    """
+    rng = np.random.default_rng(seed)
+    params = dict(nominal)
+    for name, s in sigma.items():
+        params[name] = _draw(rng, dist, nominal[name], s, n)
+        if name in POSITIVE:
+            # redraw non-physical values (truncate the distribution at 0)
+            for i in range(MAX_REDRAWS):
+                bad = params[name] <= 0
+                if not np.any(bad):
+                    break
+                params[name][bad] = _draw(rng, dist, nominal[name], s,
+                                          np.sum(bad))
+            assert np.all(params[name] > 0), \
+                "Tolerance of {0} too large to draw positive values.".format(
+                                                                        name)
+    outputs = _compute_outputs(params)
+
+    return {name : np.broadcast_to(val, (n,)) for name, val in
+            outputs.items()}
+
+
+def _draw(rng, dist, nominal, s, n):
+    """
+    Draws n values of a parameter with the nominal value and tolerance s.
+    """
+    if dist == 'normal':
+        return rng.normal(nominal, s, n)
+    return rng.uniform(nominal - s, nominal + s, n)
+
+
+def _compute_outputs(params):
+    """
+    Computes the outputs (see OUTPUTS) for the given parameters.
+    """
+    geometry = {name : params[name] for name in flow.Rig.GEOMETRY}
+    outputs = {}
+    outputs['Q_i'], outputs['Q_o'] = flow.get_flow_rates(params['eta'],
+                    p_i=params['p_i'], Q_i=params['Q_i'], p_o=params['p_o'],
+                    Q_o=params['Q_o'], **geometry)
+    # the inner stream radius is undefined if a flow rate is negative (or
+    # the total flow rate is zero)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        outputs['r_i'] = flow.get_inner_stream_radius(outputs['Q_i'],
+                                outputs['Q_o'], r_obs_cap=params['r_obs_cap'])
+    outputs['v_center'] = flow.get_velocity(outputs['Q_i'], outputs['Q_o'],
+                                            r_obs_cap=params['r_obs_cap'])
+
+    return outputs
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:12:48 2026
+
+Models a network of tubes (segments) connected at nodes, in which Poiseuille
+flow is driven by the pressures or flow rates set at some of the nodes. The
+pressure at each node and the flow rate through each segment are found by
+solving the linear system of conservation of volume at each node, so new
+plumbing (extra tubing, a second inlet, a valve modeled as a narrow segment)
+only requires adding segments instead of deriving new formulas.
+
+Parameters and boundary conditions can be arrays, which are broadcast against
+each other and solved as a batch: if the geometry and viscosity are the same
+for the whole batch, the matrix of the system is factorized once and reused
+for every set of boundary conditions. If the geometry and viscosity are
+scalars, the solution is cached as a linear map from the boundary conditions
+to the pressures and flow rates, so repeated solves (e.g., in a loop over
+pump pressures) only cost a small matrix product.
+
+Units follow flow: lengths [cm], radii [um], viscosity [Pa.s], pressures
+[bar], flow rates [uL/min].
+
+@author: Andy
+"""
+
+import warnings
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+# largest number of unknown pressures solved as dense matrices (larger
+# networks are solved as sparse matrices)
+MAX_DENSE = 50
+# largest number of solutions (sets of boundary nodes and viscosity) cached
+# by each network
+MAX_CACHED = 64
+
+
+class FlowNetwork:
+    """
+    Network of segments connected at nodes. Add segments with add_segment and
+    solve for the pressures and flow rates with solve.
+
+    Example (two tubes in series from a pump at 10 bar to atmosphere):
+        net = FlowNetwork()
+        net.add_segment('tube', 'pump', 'joint', length=20, radius=480)
+        net.add_segment('cap', 'joint', 'outlet', length=10, radius=250)
+        p, Q = net.solve({'pump' : 10, 'outlet' : 0}, eta=1.412)
+    """
+
+    def __init__(self):
+        # index of each node by name
+        self.nodes = {}
+        # (start node, end node, length, radius, viscosity) by segment name
+        self.segments = {}
+        # True if the parameters of every segment are scalars
+        self._scalar = True
+        # True if any segment has a viscosity of its own
+        self._own_eta = False
+        # incidence matrix (built when first needed)
+        self._incidence = None
+        # solutions as linear maps from the boundary conditions to the
+        # pressures and flow rates, by boundary nodes and viscosity
+        self._maps = {}
+
+    def add_segment(self, name, start, end, length, radius, eta=None):
+        """
+        Adds a segment of tubing between two nodes (nodes are created when
+        first used). Flow from start to end is positive.
+
+        inputs:
+            name        :   name of the segment
+            start       :   name of the node at the start of the segment
+            end         :   name of the node at the end of the segment
+            length      :   length of the segment [cm]
+            radius      :   inner radius of the segment [um]
+            eta         :   viscosity of the fluid in the segment [Pa.s]; if
+                                None, the viscosity given to solve is used
+        """
+        assert name not in self.segments, \
+            "Segment {0} already exists.".format(name)
+        assert start != end, "Segment {0} must join two nodes.".format(name)
+        for node in (start, end):
+            if node not in self.nodes:
+                self.nodes[node] = len(self.nodes)
+        self.segments[name] = (start, end, length, radius, eta)
+        self._scalar &= all(np.ndim(val) == 0 for val in (length, radius, eta))
+        self._own_eta |= eta is not None
+        # the cached incidence matrix and solutions are out of date
+        self._incidence = None
+        self._maps = {}
+
+    def get_incidence(self):
+        """
+        Returns the incidence matrix of the network (segments x nodes), which
+        is 1 at the start node and -1 at the end node of each segment.
+        """
+        if self._incidence is None:
+            A = np.zeros((len(self.segments), len(self.nodes)))
+            for e, (start, end, _, _, _) in enumerate(self.segments.values()):
+                A[e, self.nodes[start]] = 1
+                A[e, self.nodes[end]] = -1
+            self._incidence = A
+
+        return self._incidence.copy()
+
+    def get_conductances(self, eta=None):
+        """
+        Returns the hydraulic conductance pi*r^4/(8*eta*l) of each segment
+        [m^3/(Pa.s)] along the last axis of an array broadcast over the
+        shapes of the parameters.
+
+        inputs:
+            eta         :   viscosity of segments without their own [Pa.s]
+        """
+        g = []
+        for name, (_, _, length, radius, eta_seg) in self.segments.items():
+            eta_seg = eta if eta_seg is None else eta_seg
+            assert eta_seg is not None, \
+                "No viscosity given for segment {0}.".format(name)
+            # convert to SI
+            length = np.asarray(length) / 100 # cm -> m
+            radius = np.asarray(radius) / 1E6 # um -> m
+            g += [np.pi*radius**4/(8*eta_seg*length)]
+
+        return np.stack(np.broadcast_arrays(*g), axis=-1)
+
+    def solve(self, pressures, flows=None, eta=None):
+        """
+        Solves for the pressure at each node and the flow rate through each
+        segment. Nodes without a boundary condition conserve volume (no net
+        flow in or out).
+
+        inputs:
+            pressures   :   dictionary of pressures set at nodes [bar]. Every
+                                group of connected nodes needs at least one.
+            flows       :   dictionary of flow rates into the network at nodes
+                                (e.g., from a pump set to a flow rate)
+                                [uL/min]
+            eta         :   viscosity of segments without their own [Pa.s]
+
+        returns:
+            p           :   dictionary of the pressure at each node [bar]
+            Q           :   dictionary of the flow rate through each segment
+                                from its start to its end [uL/min]
+
+        A ValueError is raised if the system cannot be solved (e.g., a group
+        of connected nodes has no pressure set).
+        """
+        flows = {} if flows is None else flows
+        for node in list(pressures) + list(flows):
+            assert node in self.nodes, "Unknown node {0}.".format(node)
+        assert not set(pressures) & set(flows), \
+            "Set only one of pressure or flow rate at each node."
+        assert len(pressures) > 0, "Set the pressure of at least one node."
+        # reuse the solution if the matrix of the system is the same
+        if self._scalar and (np.ndim(eta) == 0 or not self._own_eta):
+            # if no segment has a viscosity of its own, every conductance
+            # scales with 1/eta, so an array of viscosities is solved with
+            # the solution for eta = 1 and flow rates eta*q set at nodes,
+            # which gives the pressures and eta times the flow rates
+            scale = np.ndim(eta) > 0
+            if scale:
+                eta_key = 1.0
+            else:
+                eta_key = None if eta is None else float(eta)
+            key = (tuple(pressures), tuple(flows), eta_key)
+            if key not in self._maps:
+                self._check_connected(pressures)
+                if len(self._maps) >= MAX_CACHED:
+                    self._maps.pop(next(iter(self._maps)))
+                self._maps[key] = self._get_linear_map(pressures, flows,
+                                                       eta_key)
+            if not scale:
+                return _apply_linear_map(self._maps[key],
+                                         list(pressures.values()) +
+                                         list(flows.values()))
+            eta = np.asarray(eta, dtype=float)
+            p, Q = _apply_linear_map(self._maps[key],
+                                     list(pressures.values()) +
+                                     [eta*np.asarray(val) for val in
+                                      flows.values()], np.shape(eta))
+            return p, {name : Q_e/eta for name, Q_e in Q.items()}
+        self._check_connected(pressures)
+
+        return self._solve(pressures, flows, eta)
+
+    def _check_connected(self, pressures):
+        """
+        Raises a ValueError if a group of connected nodes has no node with a
+        pressure set, in which case its pressures cannot be solved.
+        """
+        neighbors = {node : [] for node in self.nodes}
+        for start, end, _, _, _ in self.segments.values():
+            neighbors[start] += [end]
+            neighbors[end] += [start]
+        reached = set(pressures)
+        to_visit = list(pressures)
+        while to_visit:
+            for node in neighbors[to_visit.pop()]:
+                if node not in reached:
+                    reached.add(node)
+                    to_visit += [node]
+        if len(reached) < len(self.nodes):
+            raise ValueError("Network cannot be solved; every group " + \
+                             "of connected nodes needs a pressure.")
+
+    def _get_linear_map(self, pressures, flows, eta):
+        """
+        Returns the pressures at the nodes and flow rates through the segments
+        for a unit value of each boundary condition, from which the solution
+        for any values of the boundary conditions is their linear combination
+        (see _apply_linear_map).
+        """
+        n_bc = len(pressures) + len(flows)
+        unit = np.eye(n_bc)
+        p, Q = self._solve({node : unit[k] for k, node in
+                            enumerate(pressures)},
+                           {node : unit[k + len(pressures)] for k, node in
+                            enumerate(flows)}, eta)
+
+        return (list(p), np.stack(list(p.values()), axis=-1),
+                list(Q), np.stack(list(Q.values()), axis=-1))
+
+    def _solve(self, pressures, flows, eta):
+        """
+        Solves the linear system for the pressures and flow rates (see
+        solve).
+        """
+        g = self.get_conductances(eta)
+        # shape of the batch of parameter sets
+        shape = np.broadcast_shapes(g.shape[:-1],
+                                    *[np.shape(val) for val in
+                                      list(pressures.values()) +
+                                      list(flows.values())])
+        n_batch = int(np.prod(shape))
+        # the conductances are shared if they are the same for the whole
+        # batch (one row), otherwise there is one row per parameter set
+        if g[..., 0].size == 1:
+            g = g.reshape(1, -1)
+        else:
+            g = np.broadcast_to(g, shape + g.shape[-1:]).reshape(n_batch, -1)
+        # known (D) and unknown (U) pressures
+        D = [self.nodes[node] for node in pressures]
+        U = [i for i in range(len(self.nodes)) if i not in D]
+        p_D = np.stack([np.broadcast_to(np.asarray(val, dtype=float)*1E5,
+                                        shape).ravel()
+                        for val in pressures.values()], axis=-1)
+        q = np.zeros((n_batch, len(self.nodes)))
+        for node, val in flows.items():
+            q[:, self.nodes[node]] = np.broadcast_to(val, shape).ravel()/60E9
+        p = np.empty((n_batch, len(self.nodes)))
+        p[:, D] = p_D
+        A = self.get_incidence()
+        if len(U) > 0:
+            # conservation of volume at the unknown nodes:
+            # A_U^T diag(g) A_U p_U = q_U - A_U^T diag(g) A_D p_D
+            rhs = q[:, U] - (g*(p_D @ A[:, D].T)) @ A[:, U]
+            try:
+                if len(U) <= MAX_DENSE:
+                    p[:, U] = _solve_dense(A[:, U], g, rhs)
+                else:
+                    p[:, U] = _solve_sparse(A[:, U], g, rhs)
+            except (np.linalg.LinAlgError, RuntimeError):
+                raise ValueError("Network cannot be solved; every group " + \
+                                 "of connected nodes needs a pressure " + \
+                                 "and every segment a positive conductance.")
+        Q = g*(p @ A.T)
+        # convert to bar and uL/min with the shape of the batch
+        p = {node : (p[:, i]/1E5).reshape(shape)[()]
+             for node, i in self.nodes.items()}
+        Q = {name : (Q[:, e]*60E9).reshape(shape)[()]
+             for e, name in enumerate(self.segments)}
+
+        return p, Q
+
+
+def get_sheath_network(l_obs_cap=10, r_obs_cap=250, l_inner_cap=2.3,
+                       r_inner_cap=280, l_tube_i=20, r_tube_i=481.25,
+                       l_tube_o=20, r_tube_o=481.25, eta=None):
+    """
+    Returns the network of the sheath flow: the inner stream flows from its
+    source (node "source_i") through tubing ("tube_i") and the inner
+    capillary ("inner_cap") to the inlet of the observation capillary (node
+    "obs_cap"), where it joins the outer stream from its source ("source_o")
+    through tubing ("tube_o"). Both flow through the observation capillary
+    ("obs_cap") to the outlet ("outlet"). The node "inner_cap" is the inlet
+    of the inner capillary. Parameters are described in
+    flow.get_flow_rates.
+    """
+    net = FlowNetwork()
+    net.add_segment('tube_i', 'source_i', 'inner_cap', l_tube_i, r_tube_i,
+                    eta)
+    net.add_segment('inner_cap', 'inner_cap', 'obs_cap', l_inner_cap,
+                    r_inner_cap, eta)
+    net.add_segment('tube_o', 'source_o', 'obs_cap', l_tube_o, r_tube_o, eta)
+    net.add_segment('obs_cap', 'obs_cap', 'outlet', l_obs_cap, r_obs_cap, eta)
+
+    return net
+
+
+def _apply_linear_map(linear_map, vals, shape=()):
+    """
+    Returns the pressures and flow rates (see FlowNetwork.solve) for the
+    given values of the boundary conditions from the solution for unit
+    values (see FlowNetwork._get_linear_map), broadcast to at least the
+    given shape.
+    """
+    nodes, M_p, segments, M_Q = linear_map
+    shape = np.broadcast_shapes(shape, *[np.shape(val) for val in vals])
+    if shape == ():
+        bc = np.array(vals, dtype=float)
+    else:
+        bc = np.stack([np.broadcast_to(np.asarray(val, dtype=float), shape)
+                       for val in vals], axis=-1)
+    p = bc @ M_p
+    Q = bc @ M_Q
+
+    return ({node : p[..., i][()] for i, node in enumerate(nodes)},
+            {name : Q[..., e][()] for e, name in enumerate(segments)})
+
+
+def _solve_dense(A_U, g, rhs):
+    """
+    Solves the batch of systems A_U^T diag(g) A_U p_U = rhs with dense
+    matrices. A single matrix (one set of conductances) is factorized once
+    for all right-hand sides.
+    """
+    n = A_U.shape[1]
+    # matrix of each system as a linear function of the conductances
+    M = (A_U[:, :, np.newaxis]*A_U[:, np.newaxis, :]).reshape(len(A_U), -1)
+    G = (g @ M).reshape(-1, n, n)
+    if len(G) == 1:
+        return np.linalg.solve(G[0], rhs.T).T
+    return np.linalg.solve(G, rhs[..., np.newaxis])[..., 0]
+
+
+def _solve_sparse(A_U, g, rhs):
+    """
+    Solves the batch of systems A_U^T diag(g) A_U p_U = rhs with sparse
+    matrices. A single matrix is factorized once for all right-hand sides;
+    otherwise the matrices are solved together as one block-diagonal system.
+    """
+    n = A_U.shape[1]
+    if len(g) == 1:
+        A_U = scipy.sparse.csr_matrix(A_U)
+        G = (A_U.T @ scipy.sparse.diags(g[0]) @ A_U).tocsc()
+        return scipy.sparse.linalg.splu(G).solve(rhs.T).T
+    # every matrix has the same pattern of entries: each segment e adds
+    # A[e, i]*A[e, j]*g[e] to entry (i, j) for the unknown nodes i, j it joins
+    e_idx, cols = np.nonzero(A_U)
+    pairs = [(e, i, j) for e in np.unique(e_idx)
+             for i in cols[e_idx == e] for j in cols[e_idx == e]]
+    e_pair, i_pair, j_pair = np.array(pairs).T
+    sign = A_U[e_pair, i_pair]*A_U[e_pair, j_pair]
+    # offset the entries of each matrix to its block on the diagonal
+    offset = n*np.arange(len(g))[:, np.newaxis]
+    G = scipy.sparse.coo_matrix(((g[:, e_pair]*sign).ravel(),
+                                 ((i_pair + offset).ravel(),
+                                  (j_pair + offset).ravel())),
+                                shape=(n*len(g), n*len(g))).tocsc()
+    # spsolve only warns of a singular matrix and returns NaNs
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', scipy.sparse.linalg.MatrixRankWarning)
+        p_U = scipy.sparse.linalg.spsolve(G, rhs.ravel()).reshape(-1, n)
+    if not np.all(np.isfinite(p_U)):
+        raise RuntimeError("Matrix is singular.")
+    return p_U
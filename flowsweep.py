@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:05:37 2026
+
+Sweeps the design space of operating points of the sheath flow (inner stream
+radius, pressure drop down the observation capillary, viscosity, and tubing
+geometry) with the functions in flow. The full Cartesian grid is evaluated in
+chunks so that memory stays bounded for grids of 10^7 points or more.
+
+@author: Andy
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import flow
+
+
+# geometry parameters of flow.get_pressures and their default values
+GEOMETRY = {'l_obs_cap' : 10, 'r_obs_cap' : 250, 'l_inner_cap' : 2.3,
+            'r_inner_cap' : 280, 'l_tube_i' : 20, 'r_tube_i' : 481.25,
+            'l_tube_o' : 20, 'r_tube_o' : 481.25}
+# outputs computed for each operating point
+OUTPUTS = ['Q_i', 'Q_o', 'p_i', 'p_o', 'p_inner_cap', 'p_obs_cap',
+           'v_center', 'V_i', 'V_o', 'V_tot']
+
+
+def sweep_operating_points(r_i, dp, eta, duration=1.0, limits=None,
+                           feasible_only=True, out=None, dtype='float64',
+                           chunk_size=2**20, **geometry):
+    """
+    Computes the flow rates, pump pressures, center velocity, and volume of
+    fluid consumed for every operating point on the Cartesian grid of the
+    given parameters. Each parameter can be a scalar (held fixed) or a 1D
+    array (an axis of the grid). If all are scalars, the single operating
+    point is computed.
+
+    inputs:
+        r_i         :   radius of the inner stream [um]
+        dp          :   pressure drop down the observation capillary [bar]
+        eta         :   viscosity of fluid [Pa.s]
+        duration    :   time each operating point is run for, used to compute
+                            the volume consumed [min]
+        limits      :   dictionary of limits on outputs (see OUTPUTS) for a
+                            point to be feasible, given as the maximum or as
+                            (minimum, maximum) with None for no bound, e.g.,
+                            {'p_i' : 689, 'p_o' : 517, 'Q_o' : (10, None)}.
+                            Points must always have Q_i > 0 and Q_o >= 0.
+        feasible_only : if True, only feasible points are returned
+        out         :   if given, the points are saved to a NumPy file at
+                            this path, which is returned memory-mapped,
+                            instead of returning a dataframe
+        dtype       :   data type of the values saved to out
+        chunk_size  :   number of points evaluated at once
+        geometry    :   tubing geometry (see flow.get_pressures), defaults
+                            in GEOMETRY
+
+    returns:
+        points      :   Pandas DataFrame with a column for each parameter
+                            that is an axis of the grid, each output in
+                            OUTPUTS ([uL/min], [bar], [cm/s], [mL]), and
+                            "feasible" (if not feasible_only), or a
+                            structured memory-mapped array with the same
+                            fields if out is given
+    """
+    for key in geometry:
+        assert key in GEOMETRY, "Unknown geometry parameter {0}.".format(key)
+    params = dict(GEOMETRY, r_i=r_i, dp=dp, eta=eta, duration=duration,
+                  **geometry)
+    # parameters varied in the sweep are the axes of the grid
+    axes = {name : np.asarray(val, dtype=float).ravel()
+            for name, val in params.items() if np.ndim(val) > 0}
+    shape = tuple(len(val) for val in axes.values())
+    n_points = int(np.prod(shape))
+    columns = list(axes) + OUTPUTS
+    if out is not None:
+        fields = [(name, dtype) for name in columns]
+        if not feasible_only:
+            fields += [('feasible', bool)]
+        # points are written to the file as they are computed; if only
+        # feasible points are kept, the file is trimmed at the end
+        points = np.lib.format.open_memmap(out + '.tmp.npy' if feasible_only
+                                           else out, mode='w+',
+                                           dtype=fields, shape=(n_points,))
+        n_saved = 0
+    else:
+        chunks = []
+    for start in range(0, n_points, chunk_size):
+        stop = min(start + chunk_size, n_points)
+        chunk = _eval_chunk(params, axes, shape, start, stop)
+        feasible = _get_feasible(chunk, limits)
+        if feasible_only:
+            chunk = {name : val[feasible] for name, val in chunk.items()}
+        else:
+            chunk['feasible'] = feasible
+        if out is not None:
+            n = len(chunk['Q_i'])
+            for name in chunk:
+                points[name][n_saved:n_saved + n] = chunk[name]
+            n_saved += n
+        else:
+            chunks += [pd.DataFrame({name : chunk[name] for name in
+                columns + ([] if feasible_only else ['feasible'])})]
+    if out is None:
+        if len(chunks) == 0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(chunks, ignore_index=True)
+    if feasible_only:
+        # copy the feasible points to a file of the right size
+        trimmed = np.lib.format.open_memmap(out, mode='w+', dtype=fields,
+                                            shape=(n_saved,))
+        for start in range(0, n_saved, chunk_size):
+            stop = min(start + chunk_size, n_saved)
+            trimmed[start:stop] = points[start:stop]
+        trimmed.flush()
+        del points, trimmed
+        os.remove(out + '.tmp.npy')
+    else:
+        points.flush()
+        del points
+
+    return np.load(out, mmap_mode='r')
+
+
+def _eval_chunk(params, axes, shape, start, stop):
+    """
+    Evaluates the operating points with flat indices start to stop of the
+    grid. Returns a dictionary of the axes and outputs.
+    """
+    # values of the parameters at each point (fixed parameters are scalars);
+    # a grid without axes has a single point
+    coords = np.unravel_index(np.arange(start, stop), shape) if shape else ()
+    vals = dict(params)
+    for (name, axis), idx in zip(axes.items(), coords):
+        vals[name] = axis[idx]
+    geometry = {key : vals[key] for key in GEOMETRY}
+    chunk = {name : vals[name] for name in axes}
+    chunk['Q_i'], chunk['Q_o'] = flow.get_flow_rates_ri_dp(vals['eta'],
+                vals['r_i'], vals['dp'], r_obs_cap=geometry['r_obs_cap'],
+                l_obs_cap=geometry['l_obs_cap'])
+    chunk['p_i'], chunk['p_o'], chunk['p_inner_cap'], chunk['p_obs_cap'] = \
+            flow.get_pressures(vals['eta'], chunk['Q_i'], chunk['Q_o'],
+                               **geometry)
+    chunk['v_center'] = flow.get_velocity(chunk['Q_i'], chunk['Q_o'],
+                                          r_obs_cap=geometry['r_obs_cap'])
+    # volume consumed [uL/min * min -> mL]
+    chunk['V_i'] = chunk['Q_i']*vals['duration']/1000
+    chunk['V_o'] = chunk['Q_o']*vals['duration']/1000
+    chunk['V_tot'] = chunk['V_i'] + chunk['V_o']
+    # broadcast outputs that only depend on fixed parameters
+    n = stop - start
+    return {name : np.broadcast_to(val, (n,)) for name, val in chunk.items()}
+
+
+def _get_feasible(chunk, limits):
+    """
+    Returns an array of bools that is True for points that satisfy the
+    limits on the outputs (see sweep_operating_points).
+    """
+    feasible = (chunk['Q_i'] > 0) & (chunk['Q_o'] >= 0)
+    for name, limit in (limits or {}).items():
+        assert name in chunk, "Unknown output {0} in limits.".format(name)
+        lo, hi = limit if isinstance(limit, (tuple, list)) else (None, limit)
+        if lo is not None:
+            feasible &= chunk[name] >= lo
+        if hi is not None:
+            feasible &= chunk[name] <= hi
+
+    return feasible
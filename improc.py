@@ -7,13 +7,136 @@ Contains functions that are useful for image processing.
 @author: Andy
 """
 
+import collections
+import concurrent.futures
+import os
+import time
+
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
 import sklearn.cluster
+import skimage.draw
 import skimage.measure
 
+import data
+import timing
+import video
+
+
+# parameters held by each worker process of a pool from get_proc_pool()
+_worker_params = None
+# settings of measure_stream_width for sequences processed without a
+# dictionary of settings ([um_per_pix, bf]), which keep the reciprocal of the
+# brightfield and the output array between images
+_default_opts = {}
+# settings of measure_stream_width that do not affect the results, which are
+# left out of the hash of parameters for caching results (see also
+# _get_hashed_params)
+_UNHASHED_OPTS = ('bf_buf', 'n_refits', 'timer')
+# number of random batches fit by fit_stream_centroids(method='minibatch')
+MINIBATCH_STEPS = 10
+
+
+def fit_stream_centroids(ims, bf=None, prep=True, method='full',
+                         n_sample=10000, random_state=None, mask=None,
+                         channel=None):
+    """
+    Fits the colors of the background and the stream with k-means clustering
+    of the pixels of one or a few reference images of a sequence. The result
+    can be passed to measure_stream_width (params[2]['centroids']) so the
+    clustering is not repeated for every image of the sequence.
+
+    Fitting a subsample of the pixels makes the time and memory of the fit
+    scale with n_sample instead of the size of the image. On sheath-flow
+    images, widths measured with 'random' or 'strided' fits of 10000 pixels
+    stay within 1% (typically within one pixel) of those measured with the
+    'full' fit, since the two colors are well separated.
+    
+    Parameters:
+        ims : list of 3D arrays
+            Reference images of the sequence
+        bf : array, optional
+            Brightfield image for scaling the images
+        prep : bool, optional
+            If True, the images are scaled and converted like in
+            measure_stream_width (see prep_im). Set False if they already are.
+        method : string, optional
+            'full' clusters every pixel, 'random' clusters a random subsample
+            of n_sample pixels, 'strided' clusters every k-th pixel (about
+            n_sample in total), and 'minibatch' fits mini-batch k-means to
+            MINIBATCH_STEPS random batches of n_sample pixels (drawn from
+            the images in turn).
+        n_sample : int, optional
+            Number of pixels to fit (total over all images), or in each
+            batch for 'minibatch'
+        random_state : int, optional
+            Seed for the random subsample and k-means initialization
+        mask : array, optional
+            Region of interest of the images, given as a 2D array of bools or
+            a 1D array of indices of the flattened image (see prep_roi). Only
+            pixels in the region are clustered.
+        channel : int, string, or array-like, optional
+            If given (and prep is True), the images and brightfield image are
+            reduced to a single channel first (see select_channel), as with
+            opts['channel'] in measure_stream_width
+    
+    Returns:
+        centroids : 2D array
+            Colors of the background (row 0) and stream (row 1)
+    """
+    if prep:
+        if channel is not None:
+            ims = [select_channel(im, channel) for im in ims]
+            bf = None if bf is None else select_channel(bf, channel)
+        ims = [prep_im(im, bf) for im in ims]
+    # pixels of each image as an array of colors (views if not masked)
+    pixels_list = [_get_pixels(im, mask) for im in ims]
+    if method == 'minibatch':
+        k_means = sklearn.cluster.MiniBatchKMeans(n_clusters=2,
+                        batch_size=n_sample, random_state=random_state)
+        rng = np.random.default_rng(random_state)
+        # random batches (with replacement, which is cheaper to draw) so the
+        # time of the fit scales with n_sample, not the size of the images
+        for step in range(MINIBATCH_STEPS):
+            pixels = pixels_list[step % len(pixels_list)]
+            batch_size = max(min(n_sample, len(pixels)), 2)
+            k_means.partial_fit(pixels[rng.integers(len(pixels),
+                                                    size=batch_size)])
+    elif method in ['random', 'strided']:
+        # split the subsample evenly among the images
+        n_per_im = max(n_sample // len(pixels_list), 2)
+        rng = np.random.default_rng(random_state)
+        samples = []
+        for pixels in pixels_list:
+            if n_per_im >= len(pixels):
+                samples += [pixels]
+            elif method == 'random':
+                samples += [pixels[rng.choice(len(pixels), n_per_im,
+                                              replace=False)]]
+            else:
+                samples += [pixels[::len(pixels) // n_per_im]]
+        k_means = sklearn.cluster.KMeans(n_clusters=2,
+                        random_state=random_state).fit(np.concatenate(samples))
+    elif method == 'full':
+        # cluster the pixels of all reference images together
+        k_means = sklearn.cluster.KMeans(n_clusters=2,
+                        random_state=random_state).fit(
+                        np.concatenate(pixels_list))
+    else:
+        raise ValueError("method must be 'full', 'random', 'strided', or " + \
+                         "'minibatch', not '{0}'.".format(method))
+    centroids = k_means.cluster_centers_
+    # make sure that the stream is labeled as 1 and background as 0 by using
+    # the most common label for the top line as the background label
+    top_labels = _label_pixels(_get_pixels(ims[0], mask, top_row=True),
+                               centroids)
+    if np.mean(top_labels) > 0.5:
+        centroids = centroids[::-1]
+
+    return centroids
+
 
 def get_angle_correction(im_labeled):
     """
@@ -37,50 +160,335 @@ def get_angle_correction(im_labeled):
     return angle_correction
 
 
+def get_angle_correction_stack(stack):
+    """
+    Computes the angle correction of get_angle_correction for each frame of a
+    stack of labeled images in one vectorized pass.
+    
+    Parameters:
+        stack : 3D array of bools
+            Labeled images with shape (n_frames, rows, cols)
+    
+    Returns:
+        angle_correction : 1D array of floats
+            Cosine of the mean offset angle of each frame (NaN if a frame has
+            no labeled pixels)
+    """
+    n_frames, n_rows, n_cols = stack.shape
+    frames = np.arange(n_frames)
+    # first and last columns with labeled pixels in each frame
+    col_labeled = np.any(stack, axis=1)
+    col_min = np.argmax(col_labeled, axis=1)
+    col_max = n_cols - 1 - np.argmax(col_labeled[:, ::-1], axis=1)
+    # labeled pixels in the first and last columns, shape (n_frames, rows)
+    left = stack[frames, :, col_min]
+    right = stack[frames, :, col_max]
+    # upper left, upper right, bottom left, and bottom right rows
+    ul = np.argmax(left, axis=1)
+    ur = np.argmax(right, axis=1)
+    bl = n_rows - 1 - np.argmax(left[:, ::-1], axis=1)
+    br = n_rows - 1 - np.argmax(right[:, ::-1], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # angle along upper part of stream
+        th_u = np.arctan((ul - ur)/(col_min - col_max))
+        # angle along lower part of stream
+        th_b = np.arctan((bl - br)/(col_min - col_max))
+    # compute correction by taking cosine of mean offset angle
+    angle_correction = np.cos((th_u + th_b) / 2)
+    # frames without labeled pixels have no angle
+    angle_correction[~np.any(col_labeled, axis=1)] = np.nan
+
+    return angle_correction
+
+
+def get_centroid_drift(im, im_clustered, centroids, mask=None):
+    """
+    Measures how far the mean colors of the background and stream in a
+    labeled image have drifted from the given centroids.
+    
+    Parameters:
+        im : 2D or 3D array
+            Image that was labeled
+        im_clustered : 2D array
+            Labels of the image (0 for background, 1 for stream)
+        centroids : 2D array
+            Colors of the background (row 0) and stream (row 1)
+        mask : array, optional
+            Region of interest as a 2D array of bools or 1D array of indices of
+            the flattened image (see prep_roi)
+    
+    Returns:
+        drift : float
+            Largest distance between the mean color of a label and its
+            centroid as a fraction of the distance between the centroids
+    """
+    pixels = _get_pixels(im, mask)
+    labels = _get_pixels(im_clustered, mask).reshape(-1)
+    # distance between the centroids sets the scale of the drift
+    scale = np.linalg.norm(centroids[1] - centroids[0])
+    drift = 0
+    for i in range(2):
+        # skip labels without any pixels
+        if not np.any(labels==i):
+            continue
+        mean_color = np.mean(pixels[labels==i], axis=0)
+        drift = max(drift, np.linalg.norm(mean_color - centroids[i]) / scale)
+
+    return drift
+
+
+def get_widest_region(im_clustered):
+    """
+    Returns the connected region of labeled pixels that spans the most
+    columns (the stream). The image is labeled once and the first and last
+    column of every region are found with vectorized reductions over the
+    labeled pixels, which is much faster than looping over regionprops on
+    noisy images with many small regions (see benchmark.bench_widest_region).
+    
+    Parameters:
+        im_clustered : 2D array
+            Image with the stream labeled as nonzero and background as 0
+    
+    Returns:
+        im_stream : 2D array of bools
+            True for the pixels of the widest region. For regions of equal
+            width, the first one found scanning rows from the top is used.
+    """
+    im_labeled, num = skimage.measure.label(im_clustered, return_num=True)
+    assert num > 0, "No labeled regions found in k-means clustering."
+    n_cols = im_labeled.shape[1]
+    # label and column of each labeled pixel
+    idx = np.flatnonzero(im_labeled)
+    labels = im_labeled.ravel()[idx]
+    cols = idx % n_cols
+    # first and last column of each region (index is label)
+    col_min = np.full(num + 1, n_cols)
+    col_max = np.full(num + 1, -1)
+    np.minimum.at(col_min, labels, cols)
+    np.maximum.at(col_max, labels, cols)
+    # labels are ordered by first pixel, like the loop over regionprops
+    label = np.argmax(col_max[1:] - col_min[1:]) + 1
+
+    return im_labeled == label
+
+
+def label_by_centroids(im, centroids, mask=None):
+    """
+    Labels each pixel of the image by the nearest of the two centroids in a
+    single vectorized pass (stream = 1, background = 0).
+    
+    Parameters:
+        im : 2D or 3D array
+            Image to label
+        centroids : 2D array
+            Colors of the background (row 0) and stream (row 1)
+        mask : array, optional
+            Region of interest as a 2D array of bools or 1D array of indices of
+            the flattened image (see prep_roi). Only pixels in the region are
+            labeled; the rest are labeled as background.
+    
+    Returns:
+        im_clustered : 2D array of uint8
+            Labels of the pixels of the image
+    """
+    labels = _label_pixels(_get_pixels(im, mask), centroids)
+    if mask is None:
+        return labels.reshape(im.shape[0], im.shape[1])
+    im_clustered = np.zeros(im.shape[:2], dtype='uint8')
+    if mask.dtype == bool:
+        im_clustered[mask] = labels
+    else:
+        im_clustered.ravel()[mask] = labels
+
+    return im_clustered
+
+
 def measure_stream_width(im, params):
     """
     Computes the width of a stream of a darker color inside the image.
     
     Parameters:
+        im : 3D array
+            RGB image of the stream
+        params : list
+            [um_per_pix, bf] or [um_per_pix, bf, opts], where um_per_pix is
+            the number of microns per pixel, bf is the brightfield image (or
+            None) and opts is an optional dictionary of settings shared by
+            all images of a sequence:
+                'centroids' : 2D array
+                    Colors of the background and stream from
+                    fit_stream_centroids(). If given, the image is labeled by
+                    the nearest color instead of fitting k-means clustering.
+                'reuse_fit' : bool
+                    If True and no centroids are given, the centroids fit to
+                    this image are stored in opts['centroids'] for the next
+                    images of the sequence (each worker process of
+                    proc_im_seq(..., workers=...) keeps its own copy).
+                'drift_tol' : float
+                    If given, the centroids are fit again to this image (and
+                    updated in opts) if the colors of the labeled pixels
+                    drift from the centroids by more than this fraction of
+                    the distance between the centroids (see
+                    get_centroid_drift). opts['n_refits'] counts the refits.
+                'fit_method' : string
+                    Pixels clustered in each fit ('full', 'random',
+                    'strided', or 'minibatch', see fit_stream_centroids)
+                'n_sample' : int
+                    Number of pixels in each fit for subsampled methods
+                'bf_inv' : array of float32
+                    Reciprocal of the brightfield image (prep_brightfield).
+                    Computed from bf and stored here if not given, and
+                    computed again if opts is used with another bf (or
+                    channel). Without opts, it is kept between images
+                    (for the same bf) by this module.
+                'bf_buf' : array of float32
+                    Array reused to store each brightfield-corrected image.
+                    Allocated and stored here if not given.
+                'mask' : 2D array of bools, dict, or list of tuples
+                    Region of interest (see prep_roi). Images are cropped to
+                    its bounding box and only pixels inside it are clustered
+                    and labeled. bf (and bf_inv) are given for the full image.
+                'roi' : dict
+                    Region of interest precomputed from the mask with
+                    prep_roi. Computed and stored here if not given, and
+                    computed again if opts['mask'] is replaced by another
+                    mask (object).
+                'timer' : timing.StageTimer
+                    If given, the time of each stage of processing is
+                    recorded (set by proc_im_seq(..., timer=...))
+                'engine' : string
+                    'kmeans' (default) clusters pixels into background and
+                    stream; 'edge' finds the edges of the stream in the
+                    profile of each column (see measure_edge_width), which
+                    is faster for well-lit images. Centroid settings are
+                    ignored by the 'edge' engine.
+                'channel' : int, string, or array-like
+                    If given, each image (and bf) is reduced to a single
+                    channel right after cropping (see select_channel) and
+                    all later stages work on that channel, which moves a
+                    third of the data of the RGB path. Centroids given in
+                    opts must then have a single column (fit them with
+                    fit_stream_centroids(..., channel=...)).
+                'profile' : bool
+                    If True, the width of the stream in each column (of the
+                    region of interest, if given) is returned as a third
+                    output, e.g., to save with proc_im_seq(...,
+                    profile_store=...)
         
     Returns:
-        
+        width : float
+            Mean width of the stream [um]
+        width_std : float
+            Standard deviation of the width of the stream along the image [um]
+        profile : 1D array of float32 (if opts['profile'] is True)
+            Width of the stream in each column [um] (NaN for columns without
+            stream)
     """
     # Extract parameters: microns per pixel conversion and brightfield image
     um_per_pix = params[0]
     bf = params[1]
-    # Scale by brightfield image if provided
-    if bf is not None:
-        scale_by_brightfield(im, bf)
-    # create 0-255 uint8 copy of image
-    im = one_2_uint8(im)
+    # settings for the sequence of images
+    opts = params[2] if len(params) > 2 else _default_opts
+    # record the time of each stage if a timer is given
+    stage = timing.get_stage(opts.get('timer'))
+    return_profile = opts.get('profile', False)
+    # Crop to the region of interest, computed once for the sequence (and
+    # again if the mask changes)
+    with stage('roi'):
+        roi = _get_derived(opts, 'roi', opts.get('mask'))
+        if roi is None and opts.get('mask') is not None:
+            roi = _set_derived(opts, 'roi', prep_roi(opts['mask'], im.shape),
+                               opts['mask'])
+        mask = None
+        if roi is not None:
+            im = im[roi['bbox']]
+            mask = roi['idx']
+    # Reduce to a single channel so later stages move less data
+    channel = opts.get('channel')
+    if channel is not None:
+        with stage('channel'):
+            im = select_channel(im, channel)
+    # Correct by brightfield image, reusing its reciprocal and an output
+    # array for the whole sequence (stored in opts, and recomputed if the
+    # brightfield or channel changes)
+    with stage('brightfield'):
+        bf_inv = _get_derived(opts, 'bf_inv', bf, channel)
+        if bf is not None and bf_inv is None:
+            bf_channel = bf if channel is None else select_channel(bf, channel)
+            bf_inv = _set_derived(opts, 'bf_inv',
+                                  prep_brightfield(bf_channel), bf, channel)
+        if roi is not None and bf_inv is not None and \
+                bf_inv.shape[:2] != im.shape[:2]:
+            bf_inv = bf_inv[roi['bbox']]
+        buf = opts.get('bf_buf')
+        if bf_inv is not None and (buf is None or buf.shape != im.shape):
+            buf = np.empty(im.shape, dtype='float32')
+            opts['bf_buf'] = buf
+        im = prep_im(im, bf_inv=bf_inv, out=buf)
+    # Find the edges of the stream in each column if requested
+    if opts.get('engine', 'kmeans') == 'edge':
+        with stage('edges'):
+            return measure_edge_width(im, um_per_pix, mask=mask,
+                                      return_profile=return_profile)
     # K-means clustering into bkgd and stream (reshape im as array of RGB vals)
+    # unless the colors of the bkgd and stream are already known
     # TODO: possible extension - group using (row,col) as well
-    k_means = sklearn.cluster.KMeans(n_clusters=2).fit(im.reshape(-1,3)) 
-    im_clustered = k_means.labels_.reshape(im.shape[0], im.shape[1])
-    # make sure that the stream is labeled as 1 and background as 0 by using
-    # the most common label for the top line as the background label
-    im_clustered != (np.mean(im_clustered[0,:])>0.5)
+    fit_kwargs = {'method' : opts.get('fit_method', 'full'),
+                  'n_sample' : opts.get('n_sample', 10000), 'mask' : mask}
+    centroids = opts.get('centroids')
+    if centroids is None:
+        with stage('kmeans'):
+            centroids = fit_stream_centroids([im], prep=False, **fit_kwargs)
+        if opts.get('reuse_fit'):
+            _set_derived(opts, 'centroids', centroids)
+    # label stream as 1 and background as 0 by the nearest centroid
+    with stage('assign'):
+        im_clustered = label_by_centroids(im, centroids, mask=mask)
+    # fit the centroids again if the colors have drifted
+    drift_tol = opts.get('drift_tol')
+    if drift_tol is not None:
+        with stage('drift'):
+            drift = get_centroid_drift(im, im_clustered, centroids, mask)
+        if drift > drift_tol:
+            with stage('kmeans'):
+                centroids = fit_stream_centroids([im], prep=False,
+                                                 **fit_kwargs)
+            _set_derived(opts, 'centroids', centroids)
+            opts['n_refits'] = opts.get('n_refits', 0) + 1
+            with stage('assign'):
+                im_clustered = label_by_centroids(im, centroids, mask=mask)
     # Extract the longest labeled region
-    im_labeled = skimage.measure.label(im_clustered)
-    width_max = 0
-    label = -1
-    for region in skimage.measure.regionprops(im_labeled):
-        row_min, col_min, row_max, col_max = region.bbox
-        width = col_max - col_min
-        if width > width_max:
-            label = region.label
-            width_max = width
-    assert label >= 0, "'label'=-1', no labeled regions found in k-means clustering."
-    im_stream = (im_labeled==label)
+    with stage('label'):
+        im_stream = get_widest_region(im_clustered)
     # compute stream width and standard deviation 
-    width, width_std = measure_labeled_im_width(im_stream, um_per_pix)
+    with stage('width'):
+        result = measure_labeled_im_width(im_stream, um_per_pix,
+                                          return_profile=return_profile)
     
-    return width, width_std
+    return result
     
     
-def measure_labeled_im_width(im_labeled, um_per_pix):
+def measure_labeled_im_width(im_labeled, um_per_pix, return_profile=False):
     """
+    Measures the width of the labeled stream in each column, corrected for
+    the tilt of the stream.
+    
+    Parameters:
+        im_labeled : 2D array
+            Image with the stream labeled as nonzero and background as 0
+        um_per_pix : float
+            Number of microns per pixel
+        return_profile : bool, optional
+            If True, the width in each column is returned too
+    
+    Returns:
+        mean : float
+            Mean width of the stream [um]
+        std : float
+            Standard deviation of the width along the image [um]
+        profile : 1D array of float32 (if return_profile)
+            Width of the stream in each column [um] (NaN for columns without
+            stream)
     """
     # Count labeled pixels in each column (roughly stream width)
     num_labeled_pixels = np.sum(im_labeled, axis=0)
@@ -89,14 +497,167 @@ def measure_labeled_im_width(im_labeled, um_per_pix):
     angle_correction = get_angle_correction(im_labeled)
     stream_width_arr = num_labeled_pixels*um_per_pix*angle_correction
     # remove columns without any stream (e.g., in case of masking)
-    stream_width_arr = stream_width_arr[stream_width_arr > 0]
+    has_stream = stream_width_arr > 0
     # get mean and standard deviation
-    mean = np.mean(stream_width_arr)
-    std = np.std(stream_width_arr)
+    mean = np.mean(stream_width_arr[has_stream])
+    std = np.std(stream_width_arr[has_stream])
+    if return_profile:
+        profile = stream_width_arr.astype('float32')
+        profile[~has_stream] = np.nan
+        return mean, std, profile
     
     return mean, std
 
     
+def measure_edge_width(im, um_per_pix, mask=None, return_profile=False):
+    """
+    Measures the width of a dark, roughly horizontal stream from the intensity
+    profile of each column instead of clustering pixels. The top and bottom
+    edges of the stream in every column are found in one vectorized pass as
+    the rows where the profile crosses the midpoint between the background
+    and stream intensities, interpolated linearly to sub-pixel precision. The
+    tilt of the stream is corrected with the slopes of lines fit to the
+    edges (like get_angle_correction).
+
+    On synthetic 1920x1080 frames (benchmark.compare_engines), this takes
+    about 0.03 s per frame vs. 0.5 s for the k-means engine (~15x faster),
+    and the widths of both engines are within 0.1% of the true width for
+    clean, tilted (0.1 rad), narrow (12.5 pixel), noisy, and speckled
+    streams. It is less robust than clustering to uneven lighting (use a
+    brightfield image), dark features spanning the stream's columns (use a
+    mask), or streams with little contrast.
+    
+    Parameters:
+        im : 2D or 3D array
+            Image of the stream (grayscale or color)
+        um_per_pix : float
+            Number of microns per pixel
+        mask : array, optional
+            Region of interest as a 2D array of bools or 1D array of indices of
+            the flattened image (see prep_roi). Pixels outside it are treated
+            as background.
+        return_profile : bool, optional
+            If True, the width in each column is returned too
+    
+    Returns:
+        mean : float
+            Mean width of the stream [um]
+        std : float
+            Standard deviation of the width along the image [um]
+        profile : 1D array of float32 (if return_profile)
+            Width of the stream in each column [um] (NaN for columns where no
+            stream was found)
+    """
+    # intensity of each pixel (summing channels is faster than np.mean)
+    if im.ndim == 3:
+        gray = im[..., 0].astype('float32')
+        for i in range(1, im.shape[2]):
+            gray += im[..., i]
+        gray /= im.shape[2]
+    else:
+        gray = im.astype('float32')
+    n_rows, n_cols = gray.shape
+    # smooth along each column to reduce noise
+    smooth = gray.copy()
+    smooth[1:-1] = (gray[:-2] + gray[1:-1] + gray[2:]) / 3
+    # background and stream intensity levels (from a subsample of pixels)
+    pixels = smooth.ravel() if mask is None else _get_pixels(smooth, mask)
+    bkgd = np.percentile(pixels[::7], 90)
+    if mask is not None:
+        outside = np.ones(gray.shape, dtype=bool)
+        outside.ravel()[np.flatnonzero(mask) if mask.dtype == bool
+                        else mask] = False
+        smooth[outside] = bkgd
+    stream = np.median(np.min(smooth, axis=0))
+    thresh = (bkgd + stream) / 2
+    below = smooth < thresh
+    # center of the stream in each column: median row of the dark pixels
+    # (robust to small dark speckles outside the stream)
+    n_below = np.cumsum(below, axis=0, dtype='int32')
+    has_stream = n_below[-1] > 0
+    center = np.argmax(n_below >= (n_below[-1] + 1) // 2, axis=0)
+    # last background row above the center and first below it (-1 or n_rows
+    # if the stream reaches the border of the image)
+    rows = np.arange(n_rows)[:, np.newaxis]
+    above = ~below & (rows < center)
+    top = n_rows - 1 - np.argmax(above[::-1], axis=0)
+    top[~np.any(above, axis=0)] = -1
+    beneath = ~below & (rows > center)
+    bottom = np.argmax(beneath, axis=0)
+    bottom[~np.any(beneath, axis=0)] = n_rows
+    cols = np.arange(n_cols)
+    # interpolate the crossing of the threshold between neighboring rows
+    def crossing(r_bkgd, r_stream):
+        """Sub-pixel row where the profile crosses the threshold."""
+        inside = (r_bkgd >= 0) & (r_bkgd < n_rows)
+        r_bkgd_c = np.clip(r_bkgd, 0, n_rows - 1)
+        g_bkgd = gray[r_bkgd_c, cols]
+        g_stream = gray[np.clip(r_stream, 0, n_rows - 1), cols]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.clip((g_bkgd - thresh) / (g_bkgd - g_stream), 0, 1)
+        frac[~np.isfinite(frac)] = 0.5
+        # edges at the border of the image are at the border
+        return np.where(inside, r_bkgd + frac*(r_stream - r_bkgd),
+                        r_stream - 0.5*(r_stream - r_bkgd))
+    edge_top = crossing(top, top + 1)
+    edge_bottom = crossing(bottom, bottom - 1)
+    width_pix = edge_bottom - edge_top
+    valid = has_stream & (width_pix > 0)
+    assert np.any(valid), "No stream found in image."
+    # correct for oblique angle with the mean slope of lines fit to the edges
+    if np.sum(valid) > 1:
+        slope_top = np.polyfit(cols[valid], edge_top[valid], 1)[0]
+        slope_bottom = np.polyfit(cols[valid], edge_bottom[valid], 1)[0]
+        angle_correction = np.cos(np.arctan((slope_top + slope_bottom) / 2))
+    else:
+        angle_correction = 1
+    stream_width_arr = width_pix[valid]*um_per_pix*angle_correction
+    if return_profile:
+        profile = np.full(n_cols, np.nan, dtype='float32')
+        profile[valid] = stream_width_arr
+        return np.mean(stream_width_arr), np.std(stream_width_arr), profile
+
+    return np.mean(stream_width_arr), np.std(stream_width_arr)
+
+
+def measure_labeled_stack_width(stack, um_per_pix):
+    """
+    Measures the width of the labeled stream in each frame of a stack of
+    labeled images (like measure_labeled_im_width) in one vectorized pass.
+    
+    Parameters:
+        stack : 3D array of bools
+            Labeled images with shape (n_frames, rows, cols)
+        um_per_pix : float
+            Number of microns per pixel
+    
+    Returns:
+        mean : 1D array of floats
+            Mean width of the stream in each frame [um]
+        std : 1D array of floats
+            Standard deviation of the width in each frame [um]
+        angle_correction : 1D array of floats
+            Angle correction applied to each frame
+    """
+    # Count labeled pixels in each column of each frame, shape (n, cols)
+    num_labeled_pixels = np.sum(stack, axis=1)
+    # correct for oblique angle and convert from pixels to um
+    angle_correction = get_angle_correction_stack(stack)
+    stream_width_arr = num_labeled_pixels*um_per_pix* \
+                        angle_correction[:, np.newaxis]
+    # ignore columns without any stream (e.g., in case of masking)
+    has_stream = stream_width_arr > 0
+    # get mean and standard deviation of each frame from sums over the
+    # columns with stream (NaN for frames without stream)
+    n_cols = np.sum(has_stream, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.sum(stream_width_arr, axis=1, where=has_stream) / n_cols
+        dev = stream_width_arr - mean[:, np.newaxis]
+        std = np.sqrt(np.sum(dev**2, axis=1, where=has_stream) / n_cols)
+
+    return mean, std, angle_correction
+
+
 def one_2_uint8(im, copy=True):
     """
     Returns a copy of an image scaled from 0 to 1 as an image of uint8's scaled
@@ -116,40 +677,931 @@ def one_2_uint8(im, copy=True):
         im = np.copy(im)
     return (255*im).astype('uint8')
 
-def proc_im_seq(im_path_list, proc_fn, params, columns=None):
+def create_polygon_mask(image, points):
+    """
+    Creates a mask of the pixels inside a polygon, e.g., from
+    userinput.define_outer_edge(image, 'polygon').
+    
+    Parameters:
+        image : 2D or 3D array
+            Image the polygon was drawn on (sets the shape of the mask)
+        points : list of tuples
+            (x,y) coordinates of the vertices of the polygon
+    
+    Returns:
+        mask : 2D array of bools
+            True for pixels inside the polygon
+        points : list of tuples
+            Vertices of the polygon
+    """
+    x = np.array([pt[0] for pt in points])
+    y = np.array([pt[1] for pt in points])
+    mask = np.zeros(image.shape[:2], dtype=bool)
+    rows, cols = skimage.draw.polygon(y, x, shape=mask.shape)
+    mask[rows, cols] = True
+
+    return mask, points
+
+
+def mask_image(im, mask):
+    """
+    Returns a copy of the image with the pixels outside the mask set to 0,
+    e.g., to check a mask from userinput.get_polygonal_mask_data.
+    
+    Parameters:
+        im : 2D or 3D array
+            Image
+        mask : 2D array of bools
+            True for the pixels to keep
+    
+    Returns:
+        im_masked : array
+            Masked copy of the image
+    """
+    im_masked = np.zeros_like(im)
+    im_masked[mask] = im[mask]
+
+    return im_masked
+
+
+def prep_roi(mask, shape=None):
+    """
+    Precomputes the region of interest of a sequence of images for
+    measure_stream_width: the bounding box of the mask (to crop each image)
+    and the indices of the pixels inside the mask in the cropped image (so
+    only these pixels are clustered and labeled).
+    
+    Parameters:
+        mask : 2D array of bools, dict, or list of tuples
+            Mask of the region of interest (True inside), mask data with the
+            mask under 'mask' (e.g., from userinput.get_rect_mask_data), or
+            (x,y) vertices of a polygon (e.g., from
+            userinput.define_outer_edge)
+        shape : tuple of ints, optional
+            (rows, cols) of the images; required for polygon vertices
+    
+    Returns:
+        roi : dict
+            'bbox' : tuple of slices to crop the images
+            'mask' : 2D array of bools, mask cropped to the bounding box
+            'idx' : 1D array of indices of the pixels in the mask in the
+                flattened cropped image
+    """
+    if isinstance(mask, dict):
+        mask = mask['mask']
+    if isinstance(mask, (list, tuple)):
+        assert shape is not None, "Image shape required for polygon mask."
+        mask = create_polygon_mask(np.empty(shape[:2]), mask)[0]
+    mask = np.asarray(mask, dtype=bool)
+    assert np.any(mask), "Mask of region of interest is empty."
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    cols = np.flatnonzero(np.any(mask, axis=0))
+    bbox = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+    mask_crop = mask[bbox]
+    roi = {'bbox' : bbox, 'mask' : mask_crop,
+           'idx' : np.flatnonzero(mask_crop)}
+
+    return roi
+
+
+def select_channel(im, channel):
+    """
+    Reduces a color image to a single channel for processing. For images of
+    a blue dye on a bright background, the red channel (0) carries almost all
+    of the contrast between the stream and background.
+    
+    Parameters:
+        im : 2D or 3D array
+            Image to reduce (2D images are returned as is)
+        channel : int, string, or array-like
+            Index of the channel to keep, 'gray' for the mean of the
+            channels, or weights of the channels to sum (non-negative and
+            summing to 1 to keep the intensities on the same scale)
+    
+    Returns:
+        im_channel : 2D array
+            Contiguous copy of the channel for an index, otherwise the
+            weighted sum of the channels. uint8 images stay uint8 (rounded
+            and clipped) and other images are returned as float32.
+    """
+    if im.ndim == 2:
+        return im
+    if isinstance(channel, (int, np.integer)):
+        return np.ascontiguousarray(im[..., channel])
+    if isinstance(channel, str):
+        if channel != 'gray':
+            raise ValueError("channel must be an int, 'gray', or weights, " + \
+                             "not '{0}'.".format(channel))
+        weights = np.full(im.shape[2], 1 / im.shape[2])
+    else:
+        weights = np.asarray(channel, dtype=float)
+        assert len(weights) == im.shape[2], \
+            "Number of weights must equal the number of channels."
+    # accumulate in float32 one channel at a time (avoids a float64 copy of
+    # the whole image from np.dot)
+    im_channel = np.multiply(im[..., 0], np.float32(weights[0]),
+                             dtype='float32')
+    for i in range(1, im.shape[2]):
+        if weights[i] != 0:
+            im_channel += np.float32(weights[i])*im[..., i]
+    if im.dtype == np.uint8:
+        im_channel += 0.5
+        return np.clip(im_channel, 0, 255, out=im_channel).astype('uint8')
+
+    return im_channel
+
+
+def prep_brightfield(bf):
+    """
+    Precomputes the reciprocal of the brightfield image as float32 so that
+    each image of a sequence can be corrected with a single multiplication
+    (see apply_brightfield). Compute this once per sequence.
+    
+    Parameters:
+        bf : array of floats or ints
+            Brightfield image
+    
+    Returns:
+        bf_inv : array of float32
+            Reciprocal of the brightfield image, which is clipped to 1/255 of
+            its maximum to avoid dividing by zero
+    """
+    bf = np.asarray(bf, dtype='float32')
+    bf_min = np.max(bf) / 255.0
+    return 1 / np.maximum(bf, bf_min)
+
+
+def apply_brightfield(im, bf_inv, out=None):
+    """
+    Divides the image by the brightfield image (given as its reciprocal from
+    prep_brightfield), giving the transmitted fraction of light at each pixel.
+    
+    Parameters:
+        im : 2D or 3D array
+            Image to correct (not modified)
+        bf_inv : 2D or 3D array of float32
+            Reciprocal of the brightfield image from prep_brightfield
+        out : array of float32, optional
+            Preallocated array (same shape as im) to store the result in, so
+            no new array is allocated for each image
+    
+    Returns:
+        im_corr : array of float32
+            Image corrected by the brightfield image (out if given)
+    """
+    # apply a grayscale brightfield image to each channel of a color image
+    if bf_inv.ndim < im.ndim:
+        bf_inv = bf_inv[..., np.newaxis]
+    if out is None:
+        out = np.empty(im.shape, dtype='float32')
+
+    return np.multiply(im, bf_inv, out=out)
+
+
+def prep_im(im, bf=None, bf_inv=None, out=None):
+    """
+    Prepares an image for clustering in measure_stream_width: corrects by the
+    brightfield image if provided (as float32, see apply_brightfield) and
+    otherwise creates a 0-255 uint8 copy.
+    
+    Parameters:
+        im : 3D array
+            Image to prepare (not modified)
+        bf : array, optional
+            Brightfield image for scaling given image
+        bf_inv : array of float32, optional
+            Precomputed reciprocal of the brightfield image from
+            prep_brightfield (used instead of bf)
+        out : array of float32, optional
+            Preallocated array to store the brightfield-corrected image in
+    
+    Returns:
+        im_prep : 3D array of float32 or uint8
+            Prepared copy of the image (or the image itself if it is already
+            uint8 and not corrected, so it must not be modified)
+    """
+    # Correct by brightfield image if provided
+    if bf_inv is None and bf is not None:
+        bf_inv = prep_brightfield(bf)
+    if bf_inv is not None:
+        return apply_brightfield(im, bf_inv, out=out)
+    # images loaded from JPEG files are already 0-255 uint8 (scaling them by
+    # 255 again would wrap the values around)
+    if im.dtype == np.uint8:
+        return im
+    # create 0-255 uint8 copy of image
+    return one_2_uint8(im)
+
+
+def proc_im_seq(im_path_list, proc_fn, params, columns=None, workers=None,
+                cache_dir=None, cache_kwargs=None, timer=None, verbose=True,
+                profile_store=None):
     """
     Processes a sequence of images with the given function and returns the
     results. Images are provided as filepaths to images, which are loaded (and
-    possibly copied before analysis to preserve the image).
+    possibly copied before analysis to preserve the image), or as a frame
+    source (e.g., a video file, see video.get_frame_source).
     
     Parameters:
-        im_path_list : array-like
-            Sequence of filepaths to the images to be processed
+        im_path_list : array-like, string, or video.FrameSource
+            Sequence of filepaths to the images to be processed, filepath to
+            a video file, or source of frames
         proc_fn : function handle
             Handle of function to use to process image sequence
         params : list
             List of parameters to plug into the processing function
         columns : array-like, optional
             Results from image processing are saved to this dataframe
+        workers : int or concurrent.futures.Executor, optional
+            If given, images are processed in parallel. An int gives the
+            number of processes in a new process pool; an executor is used
+            as given (its workers must already hold the parameters, see
+            get_proc_pool). proc_fn must be defined at the module level so
+            it can be sent to the worker processes. An image that fails is
+            reported in its own row (None in the list, NaNs in the dataframe
+            with the message in an extra "error" column) instead of stopping
+            the batch.
+        cache_dir : string, optional
+            If given, results are cached in this folder (see data.ResultCache)
+            for the processing function and parameters, and only images that
+            are not in the cache (new or changed since they were cached) are
+            processed. Results of frames that are not stored in files are not
+            cached. Results of frames finished before an error are cached.
+        cache_kwargs : dict, optional
+            Keyword arguments of data.ResultCache (e.g., max_age, max_size,
+            hash_content)
+        timer : timing.StageTimer, optional
+            If given, the time to load and process each image is recorded
+            (not with workers). If params[2] is a dictionary of settings (see
+            measure_stream_width), the timer is stored in it under 'timer'
+            so the stages of processing are recorded too; it is removed and
+            the timer is closed (see timing.StageTimer.close) when
+            processing finishes.
+        verbose : bool, optional
+            If True, prints the name of each image as it is processed
+        profile_store : data.ProfileStore, optional
+            If given, the last output of proc_fn (e.g., the width profile
+            from measure_stream_width with opts['profile'] = True) is
+            appended to this store with the key of the frame as each frame
+            is finished, and left out of the returned results. Failed frames
+            are not stored. With cache_dir, profiles are stored after all
+            frames are processed, and only for frames that were processed
+            in this run or whose key is not in the store yet, so rerunning
+            a sequence does not store the profiles of cached frames again
+            (a frame that changed is stored again; its last row is current).
     
     Returns:
         output : list (optionally, Pandas DataFrame if columns given)
             Results from image processing        
     """
-    # Initialize list to store results from image processing
-    output = []
-    # Process each image in sequence.
-    for im_path in im_path_list:
-        print("Begin processing {im_path}.".format(im_path=im_path))
-        im = plt.imread(im_path)
-        output += [proc_fn(im, params)]
+    src = video.get_frame_source(im_path_list)
+    # the timer only records processing in this process
+    if workers is None:
+        _set_timer(params, timer)
+    try:
+        if cache_dir is not None:
+            output, errors = _proc_frames_cached(src, proc_fn, params,
+                                        workers, cache_dir, cache_kwargs,
+                                        timer, verbose, profile_store)
+        elif workers is not None:
+            # Process each image in parallel
+            output, errors = _proc_frames_parallel(src, proc_fn, params,
+                                                   workers, profile_store)
+        else:
+            output, errors = _proc_frames(src, proc_fn, params, timer,
+                                          verbose, profile_store)
+    finally:
+        # leave the settings as given and stop tracemalloc if the timer
+        # started it
+        _unset_timer(params, timer)
+    if profile_store is not None:
+        profile_store.flush()
     # If columns provided, convert list into a dataframe
     if columns:
-        output = pd.DataFrame(output, columns=columns)      
+        output = _make_dataframe(output, errors, columns)
         
     return output
 
 
+def proc_im_seq_parallel(im_path_list, proc_fn, params, columns=None,
+                         workers=None):
+    """
+    Processes a sequence of images in a pool of processes. The parameters are
+    sent to each worker process once when it starts (see get_proc_pool), so
+    large parameters like the brightfield image are not pickled for every
+    image. Image files are loaded by the workers; frames of other sources
+    (e.g., videos) are read in order by this process and sent to the workers.
+    Results are returned in the order of the given frames.
+    
+    Parameters:
+        im_path_list : array-like, string, or video.FrameSource
+            Sequence of filepaths to the images to be processed, filepath to
+            a video file, or source of frames
+        proc_fn : function handle
+            Module-level function to use to process image sequence
+        params : list
+            List of parameters to plug into the processing function
+        columns : array-like, optional
+            Results from image processing are saved to this dataframe
+        workers : int or concurrent.futures.Executor, optional
+            Number of processes (default is the number of CPUs) or an executor
+            created with get_proc_pool(params)
+    
+    Returns:
+        output : list (optionally, Pandas DataFrame if columns given)
+            Results from image processing. Images that raised an error are
+            None in the list or NaN in the dataframe, which then has an
+            additional "error" column with the error message for each row.
+    """
+    src = video.get_frame_source(im_path_list)
+    output, errors = _proc_frames_parallel(src, proc_fn, params, workers)
+    # If columns provided, convert list into a dataframe
+    if columns:
+        output = _make_dataframe(output, errors, columns)
+
+    return output
+
+
+def watch_im_folder(path, template, proc_fn, params, columns, csv_path=None,
+                    poll_interval=0.5, include_existing=False, max_idle=None,
+                    timeout=None, max_retries=3, callback=None):
+    """
+    Watches a folder during an experiment and processes each new image that
+    matches the template (see data.get_filepaths) shortly after it is saved.
+    A file is only processed once its size and modification time have not
+    changed between two checks, so files that are still being written are
+    skipped until they are complete. Results are appended to a CSV file as
+    they are computed. Stop watching with a keyboard interrupt (e.g., the
+    stop button in Jupyter) or with max_idle or timeout.
+    
+    Parameters:
+        path : string
+            Path to folder of images
+        template : string
+            Template for file names, using "*" for varying parts of file name
+        proc_fn : function handle
+            Handle of function to use to process each image
+        params : list
+            List of parameters to plug into the processing function
+        columns : array-like
+            Names of the results of the processing function
+        csv_path : string, optional
+            If given, each result is appended to this CSV file as a row
+        poll_interval : float, optional
+            Time between checks of the folder [s]
+        include_existing : bool, optional
+            If True, images already in the folder are processed too
+        max_idle : float, optional
+            Stop watching if no new images are processed for this long [s]
+        timeout : float, optional
+            Stop watching after this long [s]
+        max_retries : int, optional
+            Number of times to try loading an image again if it cannot be read
+            (e.g., it was not completely written) before reporting an error
+        callback : function handle, optional
+            Called with the row of results (list) of each image as it is
+            processed (e.g., to update a plot)
+    
+    Returns:
+        df : Pandas DataFrame
+            Results with the filepath of each image in the "im_path" column
+            and any error message in the "error" column, in order processed
+    """
+    all_columns = ['im_path'] + list(columns) + ['error']
+    # images that have been processed (or are ignored)
+    done = set() if include_existing else \
+            set(data.get_filepaths(path, template))
+    # size and modification time of images waiting to be processed
+    signatures = {}
+    # number of failed attempts to load each image
+    n_failed = collections.Counter()
+    rows = []
+    t_start = t_last = time.time()
+    try:
+        while True:
+            # find new images that have not changed since the last check
+            ready = []
+            for im_path in data.get_filepaths(path, template):
+                if im_path in done:
+                    continue
+                try:
+                    signature = (os.path.getsize(im_path),
+                                 os.path.getmtime(im_path))
+                except OSError:
+                    continue
+                if signature[0] > 0 and signatures.get(im_path) == signature:
+                    ready += [im_path]
+                else:
+                    signatures[im_path] = signature
+            for im_path in sorted(ready):
+                try:
+                    im = plt.imread(im_path)
+                except OSError as e:
+                    # try again later in case the image is still being written
+                    n_failed[im_path] += 1
+                    if n_failed[im_path] <= max_retries:
+                        signatures.pop(im_path)
+                        continue
+                    im = None
+                    error = repr(e)
+                done.add(im_path)
+                signatures.pop(im_path, None)
+                if im is not None:
+                    try:
+                        result = list(proc_fn(im, params))
+                        error = None
+                    except Exception as e:
+                        error = repr(e)
+                if error is not None:
+                    print("Error processing {im_path}: {e}".format(
+                            im_path=im_path, e=error))
+                    result = [np.nan]*len(columns)
+                row = [im_path] + result + [error]
+                rows += [row]
+                # append the result to the CSV file
+                if csv_path is not None:
+                    pd.DataFrame([row], columns=all_columns).to_csv(csv_path,
+                                mode='a', index=False,
+                                header=not os.path.isfile(csv_path))
+                if callback is not None:
+                    callback(row)
+                t_last = time.time()
+            # stop watching if requested
+            t_now = time.time()
+            if (max_idle is not None and t_now - t_last > max_idle) or \
+                    (timeout is not None and t_now - t_start > timeout):
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped watching {path}.".format(path=path))
+
+    return pd.DataFrame(rows, columns=all_columns)
+
+
+def test_brightfield_once(n_frames=3):
+    """
+    Checks that the brightfield is prepared once for a sequence of images
+    processed with parameters [um_per_pix, bf] (no dictionary of settings),
+    that it is prepared again if the settings are reused with another
+    brightfield, and that other processing functions still get the
+    parameters as given.
+    """
+    global prep_brightfield
+    rng = np.random.default_rng(0)
+    bf = rng.integers(200, 256, (40, 60, 3)).astype('uint8')
+    # rows 10 to 15 are dim in the images and the brightfield, so they are
+    # only part of the stream if corrected by a brightfield without them
+    bf[10:15] //= 2
+    stack = np.repeat(bf[np.newaxis], n_frames, axis=0)
+    stack[:, 15:25] //= 4
+    bf_other = bf.copy()
+    bf_other[10:15] *= 2
+    src = video.ArraySource(stack)
+    n_calls = [0]
+    prep_brightfield_orig = prep_brightfield
+    def prep_brightfield_counted(bf):
+        n_calls[0] += 1
+        return prep_brightfield_orig(bf)
+    prep_brightfield = prep_brightfield_counted
+    try:
+        params = [1, bf]
+        output = proc_im_seq(src, measure_stream_width, params,
+                             verbose=False)
+    finally:
+        prep_brightfield = prep_brightfield_orig
+    assert n_calls[0] == 1, \
+        "Brightfield prepared {0} times, not once.".format(n_calls[0])
+    assert len(output) == n_frames
+    # settings reused with another brightfield
+    opts = {}
+    width = proc_im_seq(src, measure_stream_width, [1, bf, opts],
+                        verbose=False)[0][0]
+    width_reused = proc_im_seq(src, measure_stream_width,
+                               [1, bf_other, opts], verbose=False)[0][0]
+    width_other = proc_im_seq(src, measure_stream_width, [1, bf_other, {}],
+                              verbose=False)[0][0]
+    assert width_reused == width_other != width, \
+        "Reciprocal of the previous brightfield was reused."
+    # processing functions that unpack two parameters
+    def proc_fn(im, params):
+        um_per_pix, bf = params
+        return (um_per_pix,)
+    assert proc_im_seq(src, proc_fn, [1, bf], verbose=False) == \
+        [(1,)]*n_frames
+
+    print('test_brightfield_once passed.')
+
+
+def _set_derived(opts, key, value, *sources):
+    """
+    Stores a value derived from the sources (e.g., the reciprocal of the
+    brightfield) in the settings and remembers the sources, so the value is
+    only reused for the same sources (see _get_derived). Returns the value.
+    """
+    derived = opts.setdefault('_derived', {})
+    # remember the value given by the user (if any) that this replaces
+    if key in derived and derived[key][0] is opts.get(key):
+        given = derived[key][2]
+    else:
+        given = (opts[key],) if key in opts else ()
+    opts[key] = value
+    derived[key] = (value, sources, given)
+
+    return value
+
+
+def _get_derived(opts, key, *sources):
+    """
+    Returns the value of the setting, or None if it was derived (see
+    _set_derived) from other sources than the given ones (compared by
+    identity), e.g., if the settings are reused with another brightfield.
+    Values given by the user are returned as they are.
+    """
+    value = opts.get(key)
+    derived = opts.get('_derived', {}).get(key)
+    if derived is not None and derived[0] is value and \
+            not all(_is_same(a, b) for a, b in zip(derived[1], sources)):
+        return None
+    return value
+
+
+def _is_same(a, b):
+    """
+    Returns True if a and b are the same object or equal scalars (e.g., the
+    same channel given as an int).
+    """
+    if a is b:
+        return True
+    return np.ndim(a) == 0 and np.ndim(b) == 0 and \
+            not isinstance(a, dict) and a == b
+
+
+def _get_hashed_params(params):
+    """
+    Returns the parameters as given by the user, for the hash of parameters
+    for caching results: settings that processing derived and stored in
+    params[2] (see _set_derived), e.g., the reciprocal of the brightfield or
+    centroids fit with 'reuse_fit', are replaced by the values they replaced
+    (or removed), so rerunning a sequence with the same parameters hits the
+    cache. The given list is not modified.
+    """
+    if len(params) < 3 or not isinstance(params[2], dict):
+        return params
+    opts = dict(params[2])
+    for key, (value, sources, given) in opts.pop('_derived', {}).items():
+        if opts.get(key) is value:
+            if given:
+                opts[key] = given[0]
+            else:
+                del opts[key]
+
+    return list(params[:2]) + [opts] + list(params[3:])
+
+
+def _without_timer(params):
+    """
+    Returns the parameters without the timer in the dictionary of settings
+    (params[2]), e.g., to send to worker processes, where the timer would
+    only record into a copy that is discarded. The given list is not
+    modified.
+    """
+    if len(params) > 2 and isinstance(params[2], dict) and \
+            'timer' in params[2]:
+        opts = dict(params[2])
+        del opts['timer']
+        return list(params[:2]) + [opts] + list(params[3:])
+    return params
+
+
+def _set_timer(params, timer):
+    """
+    Stores the timer in the dictionary of settings in params (params[2]), if
+    there is one, so the processing function can record its stages.
+    """
+    if timer is not None and len(params) > 2 and isinstance(params[2], dict):
+        params[2]['timer'] = timer
+
+
+def _unset_timer(params, timer):
+    """
+    Removes the timer stored by _set_timer from the dictionary of settings in
+    params (unless it was replaced) and closes the timer (see
+    timing.StageTimer.close).
+    """
+    if timer is None:
+        return
+    if len(params) > 2 and isinstance(params[2], dict) and \
+            params[2].get('timer') is timer:
+        del params[2]['timer']
+    timer.close()
+
+
+def _make_dataframe(output, errors, columns):
+    """
+    Converts the list of results into a dataframe. If errors are given (from
+    parallel processing), failed images are rows of NaNs and the errors are
+    stored in an additional "error" column.
+    """
+    if errors is None:
+        return pd.DataFrame(output, columns=columns)
+    nan_row = [np.nan]*len(columns)
+    df = pd.DataFrame([nan_row if result is None else result
+                       for result in output], columns=columns)
+    df['error'] = errors
+
+    return df
+
+
+def _proc_frames(src, proc_fn, params, timer=None, verbose=True,
+                 profile_store=None, output=None):
+    """
+    Processes the frames of the source in sequence. Returns the list of
+    results and None for the errors (errors are raised). Results are appended
+    to output if given, so they are kept if a later frame raises an error.
+    """
+    stage = timing.get_stage(timer)
+    # Initialize list to store results from image processing
+    output = [] if output is None else output
+    # Process each image in sequence.
+    frame_iter = src.iter_frames()
+    for i in range(len(src)):
+        key = src.get_key(i)
+        if verbose:
+            print("Begin processing {im_path}.".format(im_path=key))
+        if timer is not None:
+            timer.start_image(key)
+        with stage('load'):
+            frame = next(frame_iter, None)
+        # the source can end early (e.g., a video with fewer frames than
+        # reported)
+        if frame is None:
+            break
+        im = frame[1]
+        with stage('total'):
+            result = proc_fn(im, params)
+        if profile_store is not None:
+            result = _store_profile(result, key, profile_store)
+        output += [result]
+
+    return output, None
+
+
+def _proc_frames_cached(src, proc_fn, params, workers, cache_dir,
+                        cache_kwargs, timer=None, verbose=True,
+                        profile_store=None):
+    """
+    Processes the frames of the source that are not in the result cache and
+    merges their results with the cached results. Returns the list of results
+    and the list of errors (None if processed in sequence).
+    """
+    cache = data.ResultCache(cache_dir, proc_fn, _get_hashed_params(params),
+                             skip_keys=_UNHASHED_OPTS,
+                             **(cache_kwargs or {}))
+    files = [src.get_file(i) for i in range(len(src))]
+    missing = object()
+    output = [missing if file is None else cache.get(file, missing)
+              for file in files]
+    # process frames without cached results
+    todo = [i for i, result in enumerate(output) if result is missing]
+    new_output = []
+    new_errors = None
+    try:
+        if workers is not None:
+            new_output, new_errors = _proc_frames_parallel(src.subset(todo),
+                                                    proc_fn, params, workers)
+        else:
+            _proc_frames(src.subset(todo), proc_fn, params, timer, verbose,
+                         output=new_output)
+    finally:
+        # merge new results and save them in the cache (unless they failed),
+        # also if an error stopped the processing so finished frames are kept
+        for k, (i, result) in enumerate(zip(todo, new_output)):
+            output[i] = result
+            if files[i] is not None and \
+                    (new_errors is None or new_errors[k] is None):
+                cache.set(files[i], result)
+        cache.save()
+    errors = None
+    if new_errors is not None:
+        errors = [None]*len(output)
+        for i, error in zip(todo, new_errors):
+            errors[i] = error
+    # cached results include the profiles, so they are stored in order here:
+    # the profiles of new frames, and of cached frames not yet in the store
+    if profile_store is not None:
+        stored = set(profile_store.keys)
+        new = set(todo)
+        for i, result in enumerate(output):
+            if result is None:
+                continue
+            key = src.get_key(i)
+            if i in new or key not in stored:
+                output[i] = _store_profile(result, key, profile_store)
+            else:
+                output[i] = result[:-1]
+
+    return output, errors
+
+
+def _proc_frames_parallel(src, proc_fn, params, workers, profile_store=None):
+    """
+    Processes the frames of the source in a pool of processes (see
+    proc_im_seq_parallel). Returns the list of results (None for failed
+    images) and the list of errors (None for successful images).
+    """
+    # only send filepaths to the workers if the frames are image files
+    if isinstance(src, video.ImageFileSource):
+        tasks = ((im_path, _proc_im_worker, im_path)
+                 for im_path in src.im_path_list)
+    else:
+        tasks = ((key, _proc_frame_worker, im)
+                 for key, im in src.iter_frames())
+    # Create a pool that holds the parameters unless an executor is given
+    own_pool = not isinstance(workers, concurrent.futures.Executor)
+    pool = get_proc_pool(params, workers) if own_pool else workers
+    # limit the number of frames waiting to be processed to bound memory
+    n_workers = workers if isinstance(workers, int) else os.cpu_count()
+    max_pending = 4*(n_workers or 1)
+    output = []
+    errors = []
+    def collect(key, future):
+        """Stores the result or error of a finished task."""
+        try:
+            result = future.result()
+            if profile_store is not None:
+                result = _store_profile(result, key, profile_store)
+            output.append(result)
+            errors.append(None)
+        except Exception as e:
+            print("Error processing {im_path}: {e}".format(im_path=key,
+                                                           e=repr(e)))
+            output.append(None)
+            errors.append(repr(e))
+    try:
+        # collect results in the order of the frames
+        pending = collections.deque()
+        for key, fn, arg in tasks:
+            pending.append((key, pool.submit(fn, arg, proc_fn)))
+            if len(pending) >= max_pending:
+                collect(*pending.popleft())
+        while pending:
+            collect(*pending.popleft())
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    return output, errors
+
+
+def proc_im_seq_iter(im_path_list, proc_fn, params, prefetch=4, timer=None):
+    """
+    Processes a sequence of images like proc_im_seq but yields the result of
+    each image as soon as it is finished. The next images are loaded on a
+    background thread while the current image is processed, so reading and
+    decoding the files overlaps with the analysis.
+    
+    Parameters:
+        im_path_list : array-like, string, or video.FrameSource
+            Sequence of filepaths to the images to be processed, filepath to
+            a video file, or source of frames
+        proc_fn : function handle
+            Handle of function to use to process image sequence
+        params : list
+            List of parameters to plug into the processing function
+        prefetch : int, optional
+            Number of images to load ahead of the image being processed
+        timer : timing.StageTimer, optional
+            If given, the time spent waiting for each image to load and the
+            time to process it are recorded (see proc_im_seq)
+    
+    Returns:
+        generator of (key, result) : (string or int, output of proc_fn)
+            Filepath (or frame index) and result for each image in order
+    """
+    src = video.get_frame_source(im_path_list)
+    _set_timer(params, timer)
+    stage = timing.get_stage(timer)
+    try:
+        frame_iter = src.iter_frames()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as loader:
+            # queue of images being loaded in the background (the single
+            # loader thread reads the frames in order)
+            loading = collections.deque()
+            n_frames = len(src)
+            n_queued = min(max(prefetch, 1), n_frames)
+            for i in range(n_queued):
+                loading.append(loader.submit(next, frame_iter, None))
+            for i in range(n_frames):
+                future = loading.popleft()
+                # queue the next image before processing the current one
+                if n_queued < n_frames:
+                    loading.append(loader.submit(next, frame_iter, None))
+                    n_queued += 1
+                if timer is not None:
+                    timer.start_image(src.get_key(i))
+                with stage('load'):
+                    frame = future.result()
+                # the source can end early (see _proc_frames)
+                if frame is None:
+                    break
+                key, im = frame
+                with stage('total'):
+                    result = proc_fn(im, params)
+                yield key, result
+    finally:
+        # runs when the generator is finished or closed early
+        _unset_timer(params, timer)
+
+
+def get_proc_pool(params, workers=None):
+    """
+    Returns a pool of processes that each hold a copy of the parameters for
+    processing images, for use with proc_im_seq(..., workers=pool). Reusing
+    the pool for several image sequences with the same parameters avoids
+    restarting the processes.
+    
+    Parameters:
+        params : list
+            List of parameters to plug into the processing function
+        workers : int, optional
+            Number of processes (default is the number of CPUs)
+    
+    Returns:
+        pool : concurrent.futures.ProcessPoolExecutor
+            Pool of processes initialized with the parameters
+    """
+    # a timer would only record into copies in the workers
+    params = _without_timer(params)
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                initializer=_init_proc_worker,
+                                initargs=(params,))
+
+
+def _store_profile(result, key, profile_store):
+    """
+    Appends the profile (last output) of the result of a frame to the store
+    and returns the rest of the result.
+    """
+    profile_store.append(key, result[-1])
+    return result[:-1]
+
+
+def _init_proc_worker(params):
+    """
+    Stores the parameters in the worker process (called once per process).
+    """
+    global _worker_params
+    _worker_params = params
+
+
+def _proc_frame_worker(im, proc_fn):
+    """
+    Processes one frame sent to a worker process.
+    """
+    return proc_fn(im, _worker_params)
+
+
+def _proc_im_worker(im_path, proc_fn):
+    """
+    Loads and processes one image in a worker process.
+    """
+    im = plt.imread(im_path)
+    return proc_fn(im, _worker_params)
+
+
+def _get_pixels(im, mask=None, top_row=False):
+    """
+    Returns the pixels of the image (in the region of interest mask, if
+    given) as an array of colors with one row per pixel. If top_row is True,
+    only the pixels of the first row of the image (or region) are returned.
+    """
+    n_channels = im.shape[2] if im.ndim == 3 else 1
+    pixels = im.reshape(-1, n_channels)
+    if mask is None:
+        return pixels[:im.shape[1]] if top_row else pixels
+    # convert a mask of bools to indices of the flattened image
+    idx = np.flatnonzero(mask) if mask.dtype == bool else mask
+    if top_row:
+        # indices are sorted, so the first row of the region is first
+        row = idx[0] // im.shape[1]
+        idx = idx[idx < (row + 1)*im.shape[1]]
+    return np.take(pixels, idx, axis=0)
+
+
+def _label_pixels(pixels, centroids):
+    """
+    Labels each pixel (row of colors) by the nearest of the two centroids.
+    """
+    # a pixel is closer to the stream if its projection onto the line between
+    # the centroids is past the midpoint
+    diff = centroids[1] - centroids[0]
+    thresh = (np.dot(centroids[1], centroids[1]) - \
+              np.dot(centroids[0], centroids[0])) / 2
+    proj = np.dot(pixels, diff)
+
+    return (proj > thresh).astype('uint8')
+
+
 def scale_by_brightfield(im, bf):
     """
     scale pixels by value in brightfield
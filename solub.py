@@ -2,16 +2,50 @@
 """
 Created on Tue Feb 19 18:38:57 2019
 
+Interpolation functions of the solubility of CO2 in polyols and of the
+density of CO2 are built once from the data tables below and kept in a
+registry (see get_interpolator). They are built when first used, or all at
+import if the environment variable SOLUB_PRELOAD is set (e.g., to 1).
+
 @author: Andy
 """
 
+import hashlib
+import os
+
 import numpy as np
 from scipy.interpolate import interp1d
 from scipy.optimize import root
 
 
+# solubility of CO2 in each polyol by temperature [C]: pressure [psia] and
+# solubility [w/w], copy-pasted from file "co2_solubility_pressures.xlsx"
+SOLUBILITY_DATA = {
+    'VORANOL 360' : {
+        25 : np.array([[0,0],
+            [198.1, 0.0372],
+            [405.6, 0.0821],
+            [606.1, 0.1351],
+            [806.8, 0.1993],
+            [893.9, 0.2336]])
+    }
+}
+# density of CO2 by temperature [C] according to the equation of state (data
+# taken from http://www.peacesoftware.de/einigewerte/co2_e.html): pressure
+# [Pa] and density [g/mL]
+RHO_CO2_DATA = {
+    25 : np.array([1E5*np.arange(0,75,5),
+            np.array([0, 9.11, 18.725, 29.265, 39.805, 51.995, 64.185, 78.905,
+                      93.625, 112.9625, 132.3, 151.9, 258.4, 737.5,
+                      700.95])/1000]).T
+}
+# interpolation functions by (polyol, temperature, quantity), stored with the
+# hash of the data they were built from
+_interpolators = {}
+
+
 def m2p_co2_polyol(m_co2, m_polyol, rho_polyol=1.084, V=240, p0=30E5,
-                   polyol_name='VORANOL 360'):
+                   polyol_name='VORANOL 360', verbose=True):
     """
     Converts the mass of carbon dioxide (dry ice) in the Parr reactor to the
     expected pressure based on solubility in the polyol, VORANOL 360.
@@ -21,9 +55,12 @@ def m2p_co2_polyol(m_co2, m_polyol, rho_polyol=1.084, V=240, p0=30E5,
     rho_polyol : density of polyol, VORANOL 360 [g/mL]
     V : available internal volume of Parr reactor [mL]
     p0 : initial guess of pressure for nonlinear solver (~expected pressure) [Pa]
+    verbose : if True, prints the mass of CO2 in the gas and liquid phases
 
     returns :
         pressure expected based on mass of CO2 [Pa]
+
+    For many masses at once, see m2p_co2_polyol_batch.
     """
     # volume of polyol [mL]
     V_polyol = m_polyol / rho_polyol
@@ -45,12 +82,98 @@ def m2p_co2_polyol(m_co2, m_polyol, rho_polyol=1.084, V=240, p0=30E5,
     result = root(fun, p0)
     p = result.x
 
-    print('Mass in gas phase = %.2f g.' % (f_rho(p)*V_gas))
-    print('Mass in liquid phase = %.2f g.' % (f_sol(p)*m_polyol))
+    if verbose:
+        print('Mass in gas phase = %.2f g.' % (f_rho(p[0])*V_gas))
+        print('Mass in liquid phase = %.2f g.' % (f_sol(p[0])*m_polyol))
 
     return p
 
 
+def m2p_co2_polyol_batch(m_co2, m_polyol, rho_polyol=1.084, V=240,
+                         polyol_name='VORANOL 360', T=25, xtol=1,
+                         max_iter=100, verbose=False):
+    """
+    Converts masses of carbon dioxide (dry ice) in the Parr reactor to the
+    expected pressures based on solubility in the polyol, like
+    m2p_co2_polyol, but for arrays of loadings solved all at once by
+    bisection. The mass of CO2 in the gas and liquid phases increases with
+    pressure over the range of the data, so each pressure is bracketed
+    between 0 and the highest pressure of the data.
+
+    Parameters:
+        m_co2 : array-like
+            Mass of dry ice upon sealing Parr reactor [g]
+        m_polyol : array-like
+            Mass of polyol [g]
+        rho_polyol : array-like, default 1.084
+            Density of polyol [g/mL]
+        V : array-like, default 240
+            Available internal volume of Parr reactor [mL]
+        polyol_name : string, default 'VORANOL 360'
+            Name of polyol, used to load corresponding solubility data
+        T : int, default 25
+            Temperature of the data [C]
+        xtol : float, default 1
+            Tolerance of the pressure [Pa]
+        max_iter : int, default 100
+            Maximum number of bisections
+        verbose : bool, default False
+            If True, prints the mass of CO2 in the gas and liquid phases and
+            whether the solver converged for each loading
+
+    Returns:
+        p : numpy array
+            Pressure expected based on mass of CO2 [Pa], broadcast over the
+            shapes of the inputs. NaN if the mass of CO2 is outside the range
+            of the data.
+        converged : numpy array of bools
+            True where the pressure was found within xtol
+    """
+    m_co2, m_polyol, rho_polyol, V = np.broadcast_arrays(
+            *[np.asarray(val, dtype=float) for val in
+              (m_co2, m_polyol, rho_polyol, V)])
+    # volume of gaseous head space [mL]
+    V_gas = V - m_polyol / rho_polyol
+
+    # interpolation functions
+    f_sol = get_interpolator('solubility', polyol_name, T)
+    f_rho = get_interpolator('rho_co2', T=T)
+
+    def m_tot(p):
+        """
+        Total mass of CO2 in the gas and liquid phases at pressure p [g].
+        """
+        return f_rho(p)*V_gas + m_polyol*f_sol(p)
+
+    # bracket over the range covered by both sets of data
+    p_lo = np.zeros(m_co2.shape)
+    p_hi = np.full(m_co2.shape, min(f_sol.x.max(), f_rho.x.max()))
+    in_range = (m_co2 >= m_tot(p_lo)) & (m_co2 <= m_tot(p_hi)) & (V_gas >= 0)
+    for i in range(max_iter):
+        if np.all(p_hi - p_lo <= xtol):
+            break
+        p = (p_lo + p_hi) / 2
+        # the root is below p where the total mass at p exceeds m_co2
+        above = m_tot(p) > m_co2
+        p_hi = np.where(above, p, p_hi)
+        p_lo = np.where(above, p_lo, p)
+    p = (p_lo + p_hi) / 2
+    converged = in_range & (p_hi - p_lo <= xtol)
+    p = np.where(in_range, p, np.nan)
+
+    if verbose:
+        p_eval = np.where(in_range, p, 0)
+        m_gas = np.where(in_range, f_rho(p_eval)*V_gas, np.nan)
+        m_liq = np.where(in_range, f_sol(p_eval)*m_polyol, np.nan)
+        for idx in np.ndindex(p.shape):
+            print('m_co2 = %.2f g: p = %.2f bar, ' % (m_co2[idx], p[idx]/1E5) + \
+                  'mass in gas phase = %.2f g, ' % m_gas[idx] + \
+                  'mass in liquid phase = %.2f g' % m_liq[idx] + \
+                  ('.' if converged[idx] else ' (not converged).'))
+
+    return p, converged
+
+
 def p2m_co2_polyol(p, m_polyol, rho_polyol=1.084, polyol_name='VORANOL 360',
                    V=240, m0=20):
     """
@@ -97,7 +220,7 @@ def p2m_co2_polyol(p, m_polyol, rho_polyol=1.084, polyol_name='VORANOL 360',
     return m
 
     
-def interpolate_dow_solubility(polyol_name='VORANOL 360', p=None):
+def interpolate_dow_solubility(polyol_name='VORANOL 360', p=None, T=25):
     """
     Returns an interpolation function for the solubilty of VORANOL 360 at 25 C
     in terms of weight fraction as a function of the pressure in bar.
@@ -108,6 +231,8 @@ def interpolate_dow_solubility(polyol_name='VORANOL 360', p=None):
             Name of polyol, used to load corresponding solubility data
         p : int, default None
             Pressure at which solubility is desired to be interpolated
+        T : int, default 25
+            Temperature of the solubility data [C]
     
     Returns:
         if pressure 'p' not provided (p=None, default):
@@ -117,40 +242,21 @@ def interpolate_dow_solubility(polyol_name='VORANOL 360', p=None):
             f_sol(p) : int
                 Weight fraction solubility of CO2 in polyol at pressure p [bar]
     """
-    # constants
-    psi2pa = 1E5/14.5
-    
-    # copy-paste data from file "co2_solubility_pressures.xlsx" for VORANOL 360
-    if polyol_name == 'VORANOL 360':
-        data = np.array([[0,0],
-            [198.1, 0.0372],
-            [405.6, 0.0821],
-            [606.1, 0.1351],
-            [806.8, 0.1993],
-            [893.9, 0.2336]])
-    else: 
+    if T not in SOLUBILITY_DATA.get(polyol_name, {}):
         print("Data for polyol not found. Ending calculation.")
         return
-    # first column is pressure in psia
-    p_data_psia = data[:,0]
-    # second column is solubility in fraction w/w
-    solubility_data = data[:,1]
-    # convert pressure to Pa
-    p_data_pa = psi2pa * p_data_psia
-    # define interpolation function
-    f_sol = interp1d(p_data_pa, solubility_data, kind="cubic")
+    f_sol = get_interpolator('solubility', polyol_name, T)
 
     # Return weight fraction if pressure p provided
-    if p:
+    if p is not None:
         # convert pressure to Pascals
-        p *= 1E5
-        return f_sol(p)
+        return f_sol(p*1E5)
     # Otherwise, return interpolation function for weight fraction vs. pressure
     else:
         return f_sol
     
 
-def interpolate_rho_co2(p=None):
+def interpolate_rho_co2(p=None, T=25):
     """
     Returns an interpolation function for the density of carbon dioxide
     according to the equation of state (data taken from
@@ -159,16 +265,11 @@ def interpolate_rho_co2(p=None):
     Will perform the interpolation if an input pressure p is given.
     """
 
-    p_co2_pa = 1E5*np.arange(0,75,5)
-    # density in g/mL (at 25 C)
-    rho_co2 = np.array([0, 9.11, 18.725, 29.265, 39.805, 51.995, 64.185, 78.905,
-                            93.625, 112.9625, 132.3, 151.9, 258.4, 737.5, 700.95])/1000
-    f_rho = interp1d(p_co2_pa, rho_co2, kind="cubic")
+    f_rho = get_interpolator('rho_co2', T=T)
 
-    if p:
+    if p is not None:
         #pressure in Pa
-        p *= 1E5
-        return f_rho(p)
+        return f_rho(p*1E5)
     else:
         return f_rho
 
@@ -183,17 +284,11 @@ def interpolate_eos_co2(quantity, value=None):
     g/mL.
     Will perform the interpolation if a given value is given.
     """
-    #pressure in Pa
-    p_co2_pa = 1E5*np.arange(0,75,5)
-    # density in g/mL (at 25 C)
-    rho_co2 = np.array([0, 9.11, 18.725, 29.265, 39.805, 51.995, 64.185, 78.905,
-                            93.625, 112.9625, 132.3, 151.9, 258.4, 737.5, 700.95])/1000
-
     # determine appropriate interpolation function
     if quantity=='p':
-        f = interp1d(rho_co2, p_co2_pa, kind="cubic")
+        f = get_interpolator('p_co2')
     elif quantity=='rho':
-        f = interp1d(p_co2_pa, rho_co2, kind="cubic")
+        f = get_interpolator('rho_co2')
     else:
         print("please select a valid quantity: ''rho'' or ''p''")
 
@@ -204,6 +299,64 @@ def interpolate_eos_co2(quantity, value=None):
     else:
         return f(value)
 
+def get_interpolator(quantity, polyol_name=None, T=25):
+    """
+    Returns the interpolation function of a quantity from the registry,
+    building it from the data tables the first time it is requested or if
+    its data have changed since it was built.
+
+    Parameters:
+        quantity : string
+            'solubility' (weight fraction of CO2 in the polyol vs. pressure
+            [Pa]), 'rho_co2' (density of CO2 [g/mL] vs. pressure [Pa]), or
+            'p_co2' (pressure of CO2 [Pa] vs. density [g/mL])
+        polyol_name : string, optional
+            Name of the polyol (only for 'solubility')
+        T : int, default 25
+            Temperature of the data [C]
+
+    Returns:
+        f : interpolation function
+            Cubic interpolation of the data
+    """
+    if quantity == 'solubility':
+        data = SOLUBILITY_DATA[polyol_name][T]
+        # convert pressure from psia to Pa
+        x, y = 1E5/14.5*data[:,0], data[:,1]
+    elif quantity in ('rho_co2', 'p_co2'):
+        polyol_name = None
+        data = RHO_CO2_DATA[T]
+        x, y = data[:,0], data[:,1]
+        if quantity == 'p_co2':
+            x, y = y, x
+    else:
+        raise ValueError("quantity must be 'solubility', 'rho_co2', or " + \
+                         "'p_co2', not '{0}'.".format(quantity))
+    key = (polyol_name, T, quantity)
+    data_hash = hashlib.sha1(np.ascontiguousarray(data).tobytes()).hexdigest()
+    # rebuild the interpolation function only if the data changed
+    if key not in _interpolators or _interpolators[key][0] != data_hash:
+        _interpolators[key] = (data_hash, interp1d(x, y, kind="cubic"))
+
+    return _interpolators[key][1]
+
+def preload_interpolators():
+    """
+    Builds the interpolation functions of all data tables in the registry.
+    """
+    for polyol_name, data_by_T in SOLUBILITY_DATA.items():
+        for T in data_by_T:
+            get_interpolator('solubility', polyol_name, T)
+    for T in RHO_CO2_DATA:
+        get_interpolator('rho_co2', T=T)
+        get_interpolator('p_co2', T=T)
+
+def clear_interpolators():
+    """
+    Removes all interpolation functions from the registry.
+    """
+    _interpolators.clear()
+
 def usb_2_actual_pressure(p_usb, lo_usb=-3, hi_usb=639, lo_cpu=1, hi_cpu=655, cpu2actual=1/0.895):
     """
     Converts pressure read during usb powering with Samsung 5V 2.0 A USB wall adapter to
@@ -223,3 +376,6 @@ def dc_2_actual_pressure(p_dc, p_lo=0, p_hi=1500, cts_lo=207, cts_hi=1023, cts_l
     p_actual = (p_hi-p_lo)*(cts-cts_lo_actual)/(cts_hi_actual-cts_lo_actual) + p_lo
 
     return p_actual
+
+if os.environ.get('SOLUB_PRELOAD'):
+    preload_interpolators()
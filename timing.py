@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:40:12 2026
+
+Contains a timer for recording the wall time (and optionally the memory
+allocated) of each stage of processing each image, e.g., in
+improc.proc_im_seq(..., timer=timer).
+
+@author: Andy
+"""
+
+import contextlib
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+class StageTimer:
+    """
+    Records the wall time of named stages of processing for each image. If
+    track_memory is True, the memory allocated by each stage (net change and
+    peak above the start, in bytes) is recorded with tracemalloc, which slows
+    down processing.
+
+    Example:
+        timer = StageTimer()
+        timer.start_image('im1.jpg')
+        with timer.stage('load'):
+            im = plt.imread('im1.jpg')
+        timer.summary()
+
+    If tracemalloc is started by the timer, it is stopped by close() (called
+    by improc.proc_im_seq when it finishes), or on exiting a with block:
+        with StageTimer(track_memory=True) as timer:
+            ...
+    """
+
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        # one record (dict) per stage per image
+        self.records = []
+        self._image = None
+        # memory at the start and highest memory so far of each open stage
+        # (nested stages reset the peak of tracemalloc)
+        self._mem_stack = []
+        # True while tracemalloc runs because this timer started it
+        self._started_tracing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start_image(self, key):
+        """
+        Sets the image (e.g., filepath) that the next stages are recorded for.
+        """
+        self._image = key
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager that records the wall time of the code inside it as a
+        stage with the given name for the current image.
+        """
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            mem_start, mem_peak = tracemalloc.get_traced_memory()
+            # save the peak of the enclosing stage before resetting it
+            if self._mem_stack:
+                self._mem_stack[-1][1] = max(self._mem_stack[-1][1], mem_peak)
+            tracemalloc.reset_peak()
+            self._mem_stack.append([mem_start, mem_start])
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {'image' : self._image, 'stage' : name,
+                      'time' : time.perf_counter() - t_start}
+            if self.track_memory:
+                mem_end, mem_peak = tracemalloc.get_traced_memory()
+                mem_peak = max(mem_peak, self._mem_stack.pop()[1])
+                if self._mem_stack:
+                    self._mem_stack[-1][1] = max(self._mem_stack[-1][1],
+                                                 mem_peak)
+                record['alloc'] = mem_end - mem_start
+                record['peak'] = mem_peak - mem_start
+            self.records.append(record)
+
+    def close(self):
+        """
+        Stops tracemalloc if this timer started it (tracing slows down all
+        allocations). The records are kept, and the timer can still be used;
+        a new stage starts tracemalloc again. Nothing is stopped while a
+        stage is open.
+        """
+        if self._started_tracing and not self._mem_stack:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def to_dataframe(self):
+        """
+        Returns the records as a dataframe with one row per stage per image.
+        """
+        columns = ['image', 'stage', 'time']
+        if self.track_memory:
+            columns += ['alloc', 'peak']
+        return pd.DataFrame(self.records, columns=columns)
+
+    def summary(self):
+        """
+        Returns summary statistics of each stage (count, total, mean,
+        median (p50), 95th percentile (p95), and max of the time [s], and the
+        median, 95th percentile, and max of the peak allocated memory [bytes]
+        if tracked) as a dataframe indexed by stage.
+        """
+        df = self.to_dataframe()
+        rows = []
+        for name, df_stage in df.groupby('stage', sort=False):
+            t = df_stage['time'].to_numpy()
+            row = {'stage' : name, 'count' : len(t), 'total' : np.sum(t),
+                   'mean' : np.mean(t), 'p50' : np.percentile(t, 50),
+                   'p95' : np.percentile(t, 95), 'max' : np.max(t)}
+            if self.track_memory:
+                peak = df_stage['peak'].to_numpy()
+                row.update({'peak_p50' : np.percentile(peak, 50),
+                            'peak_p95' : np.percentile(peak, 95),
+                            'peak_max' : np.max(peak)})
+            rows += [row]
+
+        return pd.DataFrame(rows).set_index('stage')
+
+    def to_json(self, filepath):
+        """
+        Saves the records and summary statistics to a JSON file.
+        """
+        trace = {'records' : self.records,
+                 'summary' : self.summary().reset_index().to_dict('records')}
+        with open(filepath, 'w') as f:
+            json.dump(trace, f, indent=1, default=str)
+
+
+def get_stage(timer):
+    """
+    Returns the stage context manager of the timer, or one that does nothing
+    if no timer is given.
+    """
+    if timer is None:
+        return _no_stage
+    return timer.stage
+
+
+def _no_stage(name):
+    """
+    Context manager that does nothing (used when no timer is given).
+    """
+    return contextlib.nullcontext()
@@ -12,8 +12,8 @@ from tkinter import messagebox
 
 ##Custom modules
 #import Functions as Fun
-#import ImageProcessingFunctions as IPF
-#import VideoFunctions as VF
+import improc as IPF
+import video as VF
 
 
 def define_outer_edge(image,shapeType,message=''):
@@ -32,10 +32,6 @@ def define_outer_edge(image,shapeType,message=''):
     'rectangle': Returns array of tuples of xy-values of 4 vertices given two
                 opposite corners
     """
-    # parse input for circle
-    if shapeType == 'circle':
-        guess = np.shape(image)
-        guess = (guess[1]/2,guess[0]/2)
     # define dictionary of shapes --> shape adjectives
     shapeAdjDict = {'circle':'Circular','ellipse':'Ellipsular',
     'polygon':'Polygonal','rectangle':'Rectangular'}
@@ -68,7 +64,7 @@ def define_outer_edge(image,shapeType,message=''):
             pp = pp[0]
         # Reset the plot
         plt.cla()
-        Fun.plt_show_image(image)
+        plt.imshow(image)
         plt.title(message)
         plt.axis(lims)
         # Add the new point to the list of points and plot them
@@ -80,9 +76,8 @@ def define_outer_edge(image,shapeType,message=''):
             if len(x) > 2:
                 xp = np.array(x)
                 yp = np.array(y)
-                R,center,temp =  Fun.fit_circle(xp,yp,guess)
-                guess = center
-                X,Y = Fun.generate_circle(R,center)
+                R,center =  _fit_circle(xp,yp)
+                X,Y = _generate_circle(R,center)
                 plt.plot(X,Y,'y-',alpha=0.5)
                 plt.plot(center[0],center[1],'yx',alpha=0.5)
                 plt.draw()
@@ -102,7 +97,7 @@ def define_outer_edge(image,shapeType,message=''):
             # need 2 points to define rectangle
             if len(x) == 2:
                 # generate points defining rectangle containing xp,yp as opposite vertices
-                X,Y = Fun.generate_rectangle(x, y)
+                X,Y = _generate_rectangle(x, y)
                 # plot on figure
                 plt.plot(X,Y,'y-', alpha=0.5)
                 plt.draw()
@@ -126,29 +121,32 @@ def get_rect_mask_data(im,maskFile,check=False):
     """
     Shows user masks overlayed on given image and asks through a dialog box
     if they are acceptable. Returns True for 'yes' and False for 'no'.
+    The image may also be given as a frame source or video filepath (see
+    video.get_frame_source), in which case its first frame is used.
     """
+    if not isinstance(im, np.ndarray):
+        im = VF.extract_frame(im, 0)
     try:
         with open(maskFile, 'rb') as f:
             maskData = pkl.load(f)
     except:
         print('Mask file not found, please create it now.')
-        maskData = IPF.create_rect_mask_data(im,maskFile)
+        maskData = create_rect_mask_data(im,maskFile)
 
     while check:
         plt.figure('Evaluate accuracy of predrawn masks for your video')
         maskedImage = IPF.mask_image(im,maskData['mask'])
-        temp = np.dstack((maskedImage,im,im))
-        plt.imshow(temp)
-
-        response = ctypes.windll.user32.MessageBoxA(0, 'Do you wish to keep' + \
-                            ' the current mask?','User Input Required', 4)
+        plt.imshow(maskedImage)
+        # ask if user wishes to keep current mask (header, question)
+        response = messagebox.askyesno('User Input Required', 'Do you wish to keep' + \
+                            ' the current mask?')
         plt.close()
-        if response == 6: # 6 means yes
+        if response:
             return maskData
 
-        else: # 7 means no
+        else:
             print('Existing mask rejected, please create new one now.')
-            maskData = IPF.create_rect_mask_data(im,maskFile)
+            maskData = create_rect_mask_data(im,maskFile)
 
     return maskData
 
@@ -156,13 +154,17 @@ def get_polygonal_mask_data(im,maskFile,check=False):
     """
     Shows user masks overlayed on given image and asks through a dialog box
     if they are acceptable. Returns True for 'yes' and False for 'no'.
+    The image may also be given as a frame source or video filepath (see
+    video.get_frame_source), in which case its first frame is used.
     """
+    if not isinstance(im, np.ndarray):
+        im = VF.extract_frame(im, 0)
     try:
         with open(maskFile, 'rb') as f:
             maskData = pkl.load(f)
     except:
         print('Mask file not found, please create it now.')
-        maskData = IPF.create_polygonal_mask_data(im,maskFile)
+        maskData = create_polygonal_mask_data(im,maskFile)
 
     while check:
         plt.figure('Evaluate accuracy of predrawn masks for your video')
@@ -177,7 +179,7 @@ def get_polygonal_mask_data(im,maskFile,check=False):
 
         else:
             print('Existing mask rejected, please create new one now.')
-            maskData = IPF.create_polygonal_mask_data(im,maskFile)
+            maskData = create_polygonal_mask_data(im,maskFile)
 
     return maskData
 
@@ -190,30 +192,77 @@ def get_mask_data(maskFile,vid,hMatrix=None,check=False):
     # Parse input parameters
     image = VF.extract_frame(vid,1,hMatrix=hMatrix)
     try:
-        with open(maskFile) as f:
+        with open(maskFile, 'rb') as f:
             maskData = pkl.load(f)
     except:
         print('Mask file not found, please create it now.')
-        maskData = IPF.create_mask_data(image,maskFile)
+        maskData = create_mask_data(image,maskFile)
 
     while check:
         plt.figure('Evaluate accuracy of predrawn masks for your video')
         maskedImage = IPF.mask_image(image,maskData['mask'])
-        temp = np.dstack((maskedImage,image,image))
-        plt.imshow(temp)
+        plt.imshow(maskedImage)
         center = maskData['diskCenter']
         plt.plot(center[0],center[1],'bx')
         plt.axis('image')
-
-        response = ctypes.windll.user32.MessageBoxA(0, 'Do you wish to keep' + \
-                            ' the current mask?','User Input Required', 4)
+        # ask if user wishes to keep current mask (header, question)
+        response = messagebox.askyesno('User Input Required', 'Do you wish to keep' + \
+                            ' the current mask?')
         plt.close()
-        if response == 6: # 6 means yes
+        if response:
             return maskData
 
-        else: # 7 means no
+        else:
             print('Existing mask rejected, please create new one now.')
-            maskData = IPF.create_mask_data(image,maskFile)
+            maskData = create_mask_data(image,maskFile)
+
+    return maskData
+
+def create_rect_mask_data(im,maskFile):
+    """
+    Asks the user to click two opposite corners of a rectangle on the image
+    and saves the mask of the pixels inside it to the mask file. Returns the
+    mask data, a dictionary with the mask ('mask') and the vertices of the
+    rectangle ('points').
+    """
+    points = define_outer_edge(im,'rectangle','Click two opposite ' + \
+                               'corners of the region to keep.')
+    mask,points = IPF.create_polygon_mask(im,points)
+    maskData = {'mask':mask,'points':points}
+    with open(maskFile,'wb') as f:
+        pkl.dump(maskData,f)
+
+    return maskData
+
+def create_polygonal_mask_data(im,maskFile):
+    """
+    Asks the user to click the vertices of a polygon on the image and saves
+    the mask of the pixels inside it to the mask file. Returns the mask data,
+    a dictionary with the mask ('mask') and the vertices ('points').
+    """
+    points = define_outer_edge(im,'polygon','Click the vertices of the ' + \
+                               'region to keep.')
+    mask,points = IPF.create_polygon_mask(im,points)
+    maskData = {'mask':mask,'points':points}
+    with open(maskFile,'wb') as f:
+        pkl.dump(maskData,f)
+
+    return maskData
+
+def create_mask_data(image,maskFile):
+    """
+    Asks the user to click points on the edge of a disk on the image and
+    saves the mask of the pixels inside the fitted circle to the mask file.
+    Returns the mask data, a dictionary with the mask ('mask'), the center
+    ('diskCenter'), and the radius ('diskRadius') of the disk.
+    """
+    R,center = define_outer_edge(image,'circle','Click points on the ' + \
+                                 'edge of the disk.')
+    rows,cols = np.ogrid[:image.shape[0],:image.shape[1]]
+    mask = (cols - center[0])**2 + (rows - center[1])**2 <= R**2
+    maskData = {'mask':mask,'diskCenter':center,'diskRadius':R}
+    with open(maskFile,'wb') as f:
+        pkl.dump(maskData,f)
 
     return maskData
 
@@ -254,12 +303,39 @@ def get_homography_matrix(fileName,vid):
             with open(fileName,'rb') as f:
                 hMatrix = pkl.load(f)
         except:
+            print('Homography file not found, please create it now.')
             image = VF.extract_frame(vid,0)
+            hMatrix = create_homography_matrix(image,fileName)
     else:
         hMatrix = None
 
     return hMatrix
 
+def create_homography_matrix(image,fileName):
+    """
+    Asks the user to click the 4 corners of a feature that should be
+    rectangular (clockwise from the upper left) and saves the homography
+    matrix that maps them onto the rectangle of their bounding box (see
+    video.extract_frame) to the file. Requires OpenCV (cv2).
+    """
+    if VF.cv2 is None:
+        raise ImportError("OpenCV (cv2) is required to compute a " + \
+                          "homography matrix.")
+    points = define_outer_edge(image,'polygon','Click the 4 corners of a ' + \
+                               'rectangular feature, clockwise from the ' + \
+                               'upper left.')
+    assert len(points) == 4, "Click exactly 4 corners, not {0}.".format(
+                                                                len(points))
+    src = np.array(points, dtype='float32')
+    x0,y0 = np.min(src,axis=0)
+    x1,y1 = np.max(src,axis=0)
+    dst = np.array([(x0,y0),(x1,y0),(x1,y1),(x0,y1)], dtype='float32')
+    hMatrix = VF.cv2.getPerspectiveTransform(src,dst)
+    with open(fileName,'wb') as f:
+        pkl.dump(hMatrix,f)
+
+    return hMatrix
+
 #def get_mask_data(fileName,vid,hMatrix,check=False):
 #    """
 #    Load the mask data from file or create if it does not exist.
@@ -335,7 +411,7 @@ def get_pix_per_um(im, l_um):
             pts += clicked_pts[0]
         # Reset the plot
         plt.cla()
-        Fun.plt_show_image(im)
+        plt.imshow(im)
         plt.title(msg)
         plt.axis(lims)
         # Plot new points
@@ -352,5 +428,38 @@ def get_pix_per_um(im, l_um):
 
     return pix_per_um
 
+def _fit_circle(x,y):
+    """
+    Fits a circle to the points (x,y) by linear least squares. Returns the
+    radius and center (x,y) of the circle.
+    """
+    A = np.column_stack((x,y,np.ones(len(x))))
+    a,b,c = np.linalg.lstsq(A,x**2 + y**2,rcond=None)[0]
+    center = (a/2,b/2)
+    R = np.sqrt(c + center[0]**2 + center[1]**2)
+
+    return R,center
+
+def _generate_circle(R,center,n=100):
+    """
+    Returns the x and y values of n points around the circle.
+    """
+    theta = np.linspace(0,2*np.pi,n)
+    X = center[0] + R*np.cos(theta)
+    Y = center[1] + R*np.sin(theta)
+
+    return X,Y
+
+def _generate_rectangle(x,y):
+    """
+    Returns the x and y values of the closed outline of the rectangle with
+    the points (x[0],y[0]) and (x[1],y[1]) as opposite corners, starting at
+    the upper left and going clockwise.
+    """
+    X = [min(x),max(x),max(x),min(x),min(x)]
+    Y = [min(y),min(y),max(y),max(y),min(y)]
+
+    return np.array(X),np.array(Y)
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 13:25:06 2026
+
+Defines sources of frames (folders of images or video files) that can be
+processed with improc.proc_im_seq and used with the tools in userinput.
+
+OpenCV (cv2) is only required for reading video files and applying
+homography matrices.
+
+@author: Andy
+"""
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class FrameSource:
+    """
+    Sequence of frames with random access (get_frame) and sequential
+    streaming (iter_frames). Subclasses define __len__, get_key, and
+    get_frame, and may override iter_frames for faster sequential reading.
+    """
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def get_key(self, i):
+        """
+        Returns the key identifying frame i in results (e.g., its filepath).
+        """
+        raise NotImplementedError
+
+    def get_frame(self, i):
+        """
+        Returns frame i as an array.
+        """
+        raise NotImplementedError
+
+    def get_file(self, i):
+        """
+        Returns (filepath, index in file) of the file that frame i is stored
+        in, used to detect changes to the frame (e.g., for caching results).
+        Returns None if the frame is not stored in a file.
+        """
+        key = self.get_key(i)
+        return (key, 0) if isinstance(key, str) else None
+
+    def iter_frames(self, start=0, stop=None):
+        """
+        Yields (key, frame) for each frame from start up to (not including)
+        stop.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        for i in range(start, stop):
+            yield self.get_key(i), self.get_frame(i)
+
+    def subset(self, indices):
+        """
+        Returns a frame source of the frames with the given indices.
+        """
+        return SubsetSource(self, indices)
+
+
+class SubsetSource(FrameSource):
+    """
+    Selected frames of another frame source.
+    """
+
+    def __init__(self, src, indices):
+        self.src = src
+        self.indices = list(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get_key(self, i):
+        return self.src.get_key(self.indices[i])
+
+    def get_file(self, i):
+        return self.src.get_file(self.indices[i])
+
+    def get_frame(self, i):
+        return self.src.get_frame(self.indices[i])
+
+
+class ImageFileSource(FrameSource):
+    """
+    Frames stored as separate image files, loaded with plt.imread.
+    """
+
+    def __init__(self, im_path_list):
+        self.im_path_list = list(im_path_list)
+
+    def __len__(self):
+        return len(self.im_path_list)
+
+    def get_key(self, i):
+        return self.im_path_list[i]
+
+    def get_frame(self, i):
+        return plt.imread(self.im_path_list[i])
+
+    def subset(self, indices):
+        return ImageFileSource([self.im_path_list[i] for i in indices])
+
+
+class ArraySource(FrameSource):
+    """
+    Frames stored in an array (or memory-mapped array, see
+    data.cache_im_stack) with shape (n_frames, rows, cols[, channels]).
+    Frames are returned as views of the array without copying, so they should
+    not be modified.
+    """
+
+    def __init__(self, stack, keys=None):
+        self.stack = stack
+        self.keys = list(range(len(stack))) if keys is None else list(keys)
+        assert len(self.keys) == len(stack), \
+            "Number of keys must equal the number of frames."
+
+    def __len__(self):
+        return len(self.stack)
+
+    def get_key(self, i):
+        return self.keys[i]
+
+    def get_frame(self, i):
+        return self.stack[i]
+
+
+class VideoFileSource(FrameSource):
+    """
+    Frames of a video file, read with OpenCV as RGB arrays. The file is kept
+    open between calls, so reading consecutive frames only decodes each
+    frame once instead of reopening the file and seeking for every frame.
+    Frames are keyed by their index. The number of frames is read from the
+    file, which is often approximate; iter_frames stops at the last frame
+    that can be read and corrects the number of frames.
+    """
+
+    def __init__(self, vid_path):
+        if cv2 is None:
+            raise ImportError("OpenCV (cv2) is required to read video files.")
+        self.vid_path = vid_path
+        self._cap = None
+        # index of the frame that the next read will return
+        self._next = 0
+        cap = self._get_cap()
+        self.num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = cap.get(cv2.CAP_PROP_FPS)
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getstate__(self):
+        # an open video capture cannot be pickled (e.g., for worker
+        # processes), so it is reopened when needed
+        state = self.__dict__.copy()
+        state['_cap'] = None
+        state['_next'] = 0
+        return state
+
+    def get_key(self, i):
+        return i
+
+    def get_file(self, i):
+        return (self.vid_path, i)
+
+    def get_frame(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError("Frame {0} out of range for video with {1} frames."
+                             .format(i, len(self)))
+        cap = self._get_cap()
+        # only seek if the frame is not the next one in the file
+        if i != self._next:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+        return self._read()
+
+    def iter_frames(self, start=0, stop=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        # seek once, then decode the frames in order
+        if start < stop:
+            yield self.get_key(start), self.get_frame(start)
+        for i in range(start + 1, stop):
+            frame = self._read(strict=False)
+            # the frame count of a video is often approximate, so stop at the
+            # last frame that can be read and correct the count
+            if frame is None:
+                self.num_frames = i
+                return
+            yield self.get_key(i), frame
+
+    def close(self):
+        """
+        Closes the video file (it is reopened if more frames are read).
+        """
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+    def _get_cap(self):
+        """
+        Returns the open video capture, opening the file if necessary.
+        """
+        if self._cap is None:
+            self._cap = cv2.VideoCapture(self.vid_path)
+            assert self._cap.isOpened(), \
+                "Could not open video file {0}.".format(self.vid_path)
+            self._next = 0
+        return self._cap
+
+    def _read(self, strict=True):
+        """
+        Reads the next frame of the video as an RGB array. If the frame
+        cannot be read, an error is raised if strict, or None is returned.
+        """
+        cap = self._get_cap()
+        i = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        ret, frame = cap.read()
+        if not ret and not strict:
+            return None
+        assert ret, "Could not read frame {0} of {1}.".format(i, self.vid_path)
+        self._next = i + 1
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+
+def get_frame_source(src):
+    """
+    Returns a frame source for the given frames.
+
+    Parameters:
+        src : FrameSource, string, or array-like
+            A frame source (returned as is), the filepath to a video file, or
+            a sequence of filepaths to images
+
+    Returns:
+        frame_source : FrameSource
+            Source of the frames
+    """
+    if isinstance(src, FrameSource):
+        return src
+    elif isinstance(src, str):
+        return VideoFileSource(src)
+    else:
+        return ImageFileSource(src)
+
+
+def extract_frame(vid, num, hMatrix=None):
+    """
+    Returns a frame of a video, optionally transformed by a homography matrix.
+
+    Parameters:
+        vid : FrameSource, string, or array-like
+            Frames (see get_frame_source)
+        num : int
+            Index of the frame
+        hMatrix : 3x3 array, optional
+            Homography matrix applied to the frame with cv2.warpPerspective
+
+    Returns:
+        frame : array
+            The frame
+    """
+    frame = get_frame_source(vid).get_frame(num)
+    if hMatrix is not None:
+        if cv2 is None:
+            raise ImportError("OpenCV (cv2) is required to apply a " + \
+                              "homography matrix.")
+        frame = cv2.warpPerspective(frame, np.asarray(hMatrix),
+                                    (frame.shape[1], frame.shape[0]))
+
+    return frame